@@ -0,0 +1,74 @@
+"""
+Micro-batching de solicitudes de análisis facial
+
+Agrupa las solicitudes que llegan casi al mismo tiempo desde distintos
+hilos y las procesa con una sola pasada por lotes del detector y del
+parser. Un lote se despacha cuando alcanza `max_batch_size` elementos o
+cuando el primero lleva `max_wait_ms` milisegundos esperando.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    Args:
+        fn: Función que recibe una lista de entradas y devuelve una lista de
+            resultados del mismo largo. Un resultado que sea una instancia de
+            Exception se entrega como error solo a la solicitud que le
+            corresponde.
+        max_batch_size: Máximo de elementos por lote.
+        max_wait_ms: Tiempo máximo que se espera para completar un lote.
+    """
+
+    def __init__(self, fn, max_batch_size=8, max_wait_ms=5.0):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._loop, name='batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def run(self, item):
+        """Encola `item` y espera su resultado"""
+        return self.submit(item).result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.fn(items)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -8,20 +8,25 @@ Ejemplo: python colorInsight.py "C:/Users/foto.jpg"
 
 import sys
 import os
-from collections import Counter
 import argparse
 
 # Importar módulos del proyecto
 import functions as f
-import skin_model as m
+import telemetry
 
 
-def analizar_tono_piel(ruta_imagen):
+SIN_ROSTRO = "No se detectó ningún rostro en la imagen"
+
+
+def analizar_tono_piel(ruta_imagen, analisis=None, ruta_mascara=None):
     """
     Analiza el tono de piel de una imagen y determina el tipo de color personal
     
     Args:
         ruta_imagen: Ruta al archivo de imagen
+        analisis: Resultado previo de f.analyze_colors (opcional) para no
+            repetir la detección, el parsing ni la clasificación
+        ruta_mascara: Si se indica, guarda ahí la máscara de piel (depuración)
         
     Returns:
         dict con el resultado del análisis
@@ -37,27 +42,19 @@ def analizar_tono_piel(ruta_imagen):
         print(f"📁 Procesando: {ruta_imagen}")
         print("⏳ Extrayendo máscara de piel...")
         
-        # Crear archivos temporales
-        temp_saved = "temp_saved.jpg"
-        temp_mask = "temp_mask.jpg"
-        
-        # Copiar imagen a archivo temporal
-        import shutil
-        shutil.copy(ruta_imagen, temp_saved)
-        
-        # Extraer máscara de piel
-        f.save_skin_mask(temp_saved)
-        
+        # Reutiliza el análisis si ya existe; si no, lo toma de la caché
+        # o ejecuta los modelos
         print("🧠 Analizando con modelo de deep learning...")
+        if analisis is None:
+            analisis = f.analyze_colors(ruta_imagen, parts=('skin',),
+                                        mask_path=ruta_mascara)
+        if not analisis['face_found']:
+            print(f"\n❌ {SIN_ROSTRO}")
+            return {"error": SIN_ROSTRO}
         
-        # Analizar con el modelo
-        ans = m.get_season("temp.jpg")
-        
-        # Limpiar archivos temporales
-        if os.path.exists("temp.jpg"):
-            os.remove("temp.jpg")
-        if os.path.exists(temp_saved):
-            os.remove(temp_saved)
+        probs = analisis['skin_probs']
+        ans = max(range(len(probs)), key=probs.__getitem__)
+        print("Decided color: ", ans)
         
         # Mapear resultado
         if ans == 3:
@@ -100,12 +97,14 @@ def analizar_tono_piel(ruta_imagen):
         return {"error": error_msg}
 
 
-def analizar_color_labios(ruta_imagen):
+def analizar_color_labios(ruta_imagen, analisis=None):
     """
     Analiza el color de labios de una imagen
     
     Args:
         ruta_imagen: Ruta al archivo de imagen
+        analisis: Resultado previo de f.analyze_colors (opcional) para no
+            repetir la detección y el parsing
         
     Returns:
         dict con el resultado del análisis
@@ -121,24 +120,22 @@ def analizar_color_labios(ruta_imagen):
         print(f"📁 Procesando: {ruta_imagen}")
         print("⏳ Extrayendo códigos RGB de labios...")
         
-        # Extraer códigos RGB
-        rgb_codes = f.get_rgb_codes(ruta_imagen)
-        
-        print(f"📊 {len(rgb_codes)} píxeles de labios detectados")
-        print("🎲 Seleccionando muestra aleatoria de 40 píxeles...")
+        # Votación determinista sobre todos los píxeles filtrados
+        if analisis is None:
+            analisis = f.analyze_colors(ruta_imagen, parts=('lips',))
+        if not analisis['face_found']:
+            print(f"\n❌ {SIN_ROSTRO}")
+            return {"error": SIN_ROSTRO}
+        summary = analisis['lips']
+        types = summary['votes']
         
-        # Filtrar y seleccionar muestra aleatoria
-        random_rgb_codes = f.filter_lip_random(rgb_codes, 40)
+        print(f"📊 {summary['pixels']} píxeles de labios utilizados")
         
-        print("🧮 Calculando distancias a paletas de referencia...")
+        print(f"📈 Distribución: {types}")
+        print(f"🎯 Confianza: {summary['confidence']:.1%}")
         
-        # Calcular distancias
-        types = Counter(f.calc_dis(random_rgb_codes))
-        
-        print(f"📈 Distribución: {dict(types)}")
-        
-        # Obtener el tipo más común
-        max_value_key = max(types, key=types.get)
+        # Obtener el tipo más votado
+        max_value_key = summary['type']
         
         # Mapear a código numérico
         type_mapping = {
@@ -170,7 +167,8 @@ def analizar_color_labios(ruta_imagen):
             "temporada": season_names.get(result, "Desconocido"),
             "tipo_analisis": max_value_key,
             "descripcion": season_descriptions.get(result, ""),
-            "distribucion": dict(types)
+            "distribucion": types,
+            "confianza": summary['confidence']
         }
         
         print("\n✅ RESULTADO:")
@@ -188,23 +186,45 @@ def analizar_color_labios(ruta_imagen):
         return {"error": error_msg}
 
 
-def analizar_completo(ruta_imagen):
+def analizar_completo(ruta_imagen, ruta_mascara=None, imagen=None, datos=None,
+                      clave=None):
     """
     Realiza análisis completo: tono de piel y color de labios
     
     Args:
         ruta_imagen: Ruta al archivo de imagen
+        ruta_mascara: Ruta opcional donde guardar la máscara de piel
+        imagen: La misma imagen ya decodificada (RGB uint8, opcional) para
+            no volver a leerla del disco
+        datos: Los bytes del archivo ya leídos (opcional); identifican la
+            imagen en la caché de resultados
+        clave: La clave de `datos` en la caché (opcional, ver
+            functions.cache_key) para no volver a calcularla
     """
     print("\n" + "🌟"*30)
     print("   COLORINSIGHT - ANÁLISIS COMPLETO DE COLOR PERSONAL")
     print("🌟"*30)
     print(f"\n📷 Imagen: {ruta_imagen}\n")
     
+    # Una sola pasada de detección y parsing para ambos análisis (o
+    # ninguna si la imagen ya está en la caché)
+    try:
+        analisis = f.analyze_colors(ruta_imagen if datos is None else datos,
+                                    image=imagen, mask_path=ruta_mascara, key=clave)
+    except Exception as e:
+        import traceback
+        error_msg = f"Error al procesar la imagen: {str(e)}\n{traceback.format_exc()}"
+        print(f"\n❌ {error_msg}")
+        return {
+            "tono_piel": {"error": error_msg},
+            "color_labios": {"error": error_msg}
+        }
+    
     # Análisis de tono de piel
-    resultado_piel = analizar_tono_piel(ruta_imagen)
+    resultado_piel = analizar_tono_piel(ruta_imagen, analisis)
     
     # Análisis de color de labios
-    resultado_labios = analizar_color_labios(ruta_imagen)
+    resultado_labios = analizar_color_labios(ruta_imagen, analisis)
     
     # Resumen final
     print("\n" + "="*60)
@@ -248,6 +268,9 @@ Ejemplos de uso:
   
   # Solo análisis de color de labios
   python colorInsight.py "C:/Users/foto.jpg" --lip
+  
+  # Tiempo de cada etapa (decodificación, detección, parsing, ...)
+  python colorInsight.py "C:/Users/foto.jpg" --profile
         """
     )
     
@@ -269,6 +292,19 @@ Ejemplos de uso:
         help='Realizar solo análisis de color de labios'
     )
     
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Mostrar el tiempo de cada etapa del pipeline al terminar'
+    )
+    
+    parser.add_argument(
+        '--mascara',
+        type=str,
+        default=None,
+        help='Guardar la máscara de piel en esta ruta (depuración)'
+    )
+    
     # Si no hay argumentos, mostrar ayuda
     if len(sys.argv) == 1:
         parser.print_help()
@@ -283,12 +319,15 @@ Ejemplos de uso:
     
     # Ejecutar análisis según las opciones
     if args.skin:
-        analizar_tono_piel(args.imagen)
+        analizar_tono_piel(args.imagen, ruta_mascara=args.mascara)
     elif args.lip:
         analizar_color_labios(args.imagen)
     else:
         # Por defecto, análisis completo
-        analizar_completo(args.imagen)
+        analizar_completo(args.imagen, ruta_mascara=args.mascara)
+    
+    if args.profile:
+        telemetry.imprimir_perfil()
 
 
 if __name__ == "__main__":
@@ -80,6 +80,60 @@ def enviar_imagen_lip_color(ruta_imagen: str, api_url: str = "http://localhost:8
         return None
 
 
+def enviar_imagen_multipart(ruta_imagen: str, api_url: str = "http://localhost:8000/image"):
+    """
+    Envía la imagen como multipart/form-data (sin base64, ~33% menos datos)
+    
+    Args:
+        ruta_imagen: Ruta al archivo de imagen (jpg, png, etc.)
+        api_url: URL del endpoint (/image o /lip)
+    
+    Returns:
+        Respuesta de la API
+    """
+    try:
+        with open(ruta_imagen, 'rb') as image_file:
+            response = requests.post(api_url, files={"image": image_file})
+        response.raise_for_status()
+        
+        print(f"✅ Respuesta exitosa: {response.json()}")
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Error: {e}")
+        if hasattr(e.response, 'text'):
+            print(f"Detalles: {e.response.text}")
+        return None
+
+
+def enviar_imagen_binaria(ruta_imagen: str, api_url: str = "http://localhost:8000/image"):
+    """
+    Envía los bytes de la imagen directamente como application/octet-stream
+    
+    Args:
+        ruta_imagen: Ruta al archivo de imagen (jpg, png, etc.)
+        api_url: URL del endpoint (/image o /lip)
+    
+    Returns:
+        Respuesta de la API
+    """
+    try:
+        with open(ruta_imagen, 'rb') as image_file:
+            response = requests.post(
+                api_url,
+                data=image_file.read(),
+                headers={"Content-Type": "application/octet-stream"}
+            )
+        response.raise_for_status()
+        
+        print(f"✅ Respuesta exitosa: {response.json()}")
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Error: {e}")
+        if hasattr(e.response, 'text'):
+            print(f"Detalles: {e.response.text}")
+        return None
+
+
 # Ejemplo de uso
 if __name__ == "__main__":
     # Reemplaza con la ruta a tu imagen
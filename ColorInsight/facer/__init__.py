@@ -1,7 +1,7 @@
 from typing import Optional, Tuple
 import torch
 
-from .io import read_hwc, write_hwc
+from .io import decode_hwc, read_hwc, write_hwc
 from .util import hwc2bchw, bchw2hwc
 from .draw import draw_bchw
 from .show import show_bchw, show_bhw
@@ -18,19 +18,19 @@ def _split_name(name: str) -> Tuple[str, Optional[str]]:
     return detector_type, conf_name
 
 
-def face_detector(name: str, device: torch.device) -> FaceDetector:
+def face_detector(name: str, device: torch.device, **options) -> FaceDetector:
     detector_type, conf_name = _split_name(name)
     if detector_type == 'retinaface':
         from .face_detection import RetinaFaceDetector
-        return RetinaFaceDetector(conf_name).to(device)
+        return RetinaFaceDetector(conf_name, **options).to(device)
     else:
         raise RuntimeError(f'Unknown detector type: {detector_type}')
 
 
-def face_parser(name: str, device: torch.device) -> FaceParser:
+def face_parser(name: str, device: torch.device, **options) -> FaceParser:
     parser_type, conf_name = _split_name(name)
     if parser_type == 'farl':
         from .face_parsing import FaRLFaceParser
-        return FaRLFaceParser(conf_name, device=device).to(device)
+        return FaRLFaceParser(conf_name, device=device, **options).to(device)
     else:
         raise RuntimeError(f'Unknown parser type: {parser_type}')
@@ -42,65 +42,122 @@ _names_in_static_label_colors = [
 ]
 
 
-def _blend_labels(image, labels, label_names_dict=None,
-                  default_alpha=0.6, color_offset=None):
-    assert labels.ndim == 2
-    bg_mask = labels == 0
+def _label_colors(label_names_dict, nlabels: int, color_offset=None):
+    """ Color lookup table for labels `0 .. nlabels-1`.
+
+    Returns:
+        colors: nlabels x 3 float32 in [0, 1].
+        foreground: nlabels bool, False for the background and for labels
+            missing from a `label_names_dict` dict (both are left unblended).
+    """
+    foreground = np.ones(nlabels, bool)
+    foreground[0] = False
     if label_names_dict is None:
-        colors = _static_label_colors
+        palette = np.stack(_static_label_colors).astype(np.float32)
+        colors = palette[np.arange(nlabels) % len(palette)]
     else:
-        colors = [np.array((1.0, 1.0, 1.0), np.float32)]
-        for i in range(1, labels.max() + 1):
+        colors = np.ones((nlabels, 3), np.float32)
+        for i in range(1, nlabels):
             if isinstance(label_names_dict, dict) and i not in label_names_dict:
-                bg_mask = np.logical_or(bg_mask, labels == i)
-                colors.append(np.zeros((3)))
+                foreground[i] = False
+                colors[i] = 0
                 continue
             label_name = label_names_dict[i]
             if label_name in _names_in_static_label_colors:
-                color = _static_label_colors[
-                    _names_in_static_label_colors.index(
-                        label_name)]
-            else:
-                color = np.array((1.0, 1.0, 1.0), np.float32)
-            colors.append(color)
+                colors[i] = _static_label_colors[
+                    _names_in_static_label_colors.index(label_name)]
 
     if color_offset is not None:
-        ncolors = []
-        for c in colors:
-            nc = np.array(c)
-            if (nc != np.zeros(3)).any():
-                nc += color_offset
-            ncolors.append(nc)
-        colors = ncolors
+        colors = colors + (colors != 0).any(axis=1, keepdims=True) * \
+            np.asarray(color_offset, np.float32)
+    return colors, foreground
+
+
+def _blend_labels(image, labels, label_names_dict=None,
+                  default_alpha=0.6, color_offset=None):
+    assert labels.ndim == 2
+    colors, foreground = _label_colors(
+        label_names_dict, int(labels.max()) + 1, color_offset)
 
     if image is None:
-        image = orig_image = np.zeros(
-            [labels.shape[0], labels.shape[1], 3], np.float32)
-        alpha = 1.0
+        orig_image = np.zeros([labels.shape[0], labels.shape[1], 3], np.float32)
+        image = colors[labels]
     else:
         orig_image = image / np.max(image)
-        image = orig_image * (1.0 - default_alpha)
-        alpha = default_alpha
-    for i in range(1, np.max(labels) + 1):
-        image += alpha * \
-            np.tile(
-                np.expand_dims(
-                    (labels == i).astype(np.float32), -1),
-                [1, 1, 3]) * colors[(i) % len(colors)]
-    image[np.where(image > 1.0)] = 1.0
-    image[np.where(image < 0)] = 0.0
-    image[np.where(bg_mask)] = orig_image[np.where(bg_mask)]
-    return image
+        image = orig_image * (1.0 - default_alpha) + \
+            default_alpha * colors[labels]
+    image = np.clip(image, 0.0, 1.0)
+    return np.where(foreground[labels][..., None], image, orig_image)
+
+
+def _blend_labels_lut(image, labels, label_names_dict=None, alpha=0.6):
+    """ Blend a label map onto an image with a single color-table lookup.
+
+    Args:
+        image: h x w x 3 image in [0, 255], either a uint8 numpy array or a
+            torch tensor of any dtype (blended on its own device).
+        labels: h x w integer label map of the same kind as `image`.
+
+    Returns:
+        The blended image, same type, dtype and device as `image`.
+    """
+    nlabels = int(labels.max()) + 1
+    colors, foreground = _label_colors(label_names_dict, nlabels)
+    colors = np.round(colors * 255).clip(0, 255)
+
+    if isinstance(image, torch.Tensor):
+        labels = labels.long()
+        colors = torch.from_numpy(colors).to(image.device)
+        foreground = torch.from_numpy(foreground).to(image.device)
+        blended = image.float() * (1.0 - alpha) + alpha * colors[labels]
+        if not image.is_floating_point():
+            blended = blended.round().clamp(0, 255)
+        return torch.where(foreground[labels][..., None],
+                           blended.to(image.dtype), image)
+
+    # uint8 fixed point: (image * (256 - a) + color * a + 128) >> 8
+    a = int(round(alpha * 256))
+    tinted = colors.astype(np.uint16) * a + 128  # nlabels x 3
+    labels = labels.astype(np.intp, copy=False)
+    blended = (image.astype(np.uint16) * (256 - a) + tinted[labels]) >> 8
+    return np.where(foreground[labels][..., None],
+                    blended.astype(np.uint8), image)
+
+
+def _seg_label_maps(batch_content):
+    if 'labels' in batch_content:
+        return batch_content['labels']  # nfaces x h x w
+    # nfaces x nclasses x h x w
+    return batch_content['logits'].argmax(dim=1)
 
 
 def _draw_hwc(image: torch.Tensor, data: Dict[str, torch.Tensor]):
     device = image.device
-    image = np.array(image.cpu().numpy(), copy=True)
-    dtype = image.dtype
     h, w, _ = image.shape
 
+    # label maps are blended on the image's device; the antialiased
+    # rects/points are drawn with skimage on a numpy copy
+    image_np = None
+
+    def as_numpy():
+        nonlocal image, image_np
+        if image_np is None:
+            image_np = np.array(image.cpu().numpy(), copy=True)
+            image = None
+        return image_np
+
+    def as_tensor():
+        nonlocal image, image_np
+        if image is None:
+            image = torch.from_numpy(image_np).to(device=device)
+            image_np = None
+        else:
+            image = image.clone()
+        return image
+
     for tag, batch_content in data.items():
         if tag == 'rects':
+            image_np = as_numpy()
             for content in batch_content:
                 x1, y1, x2, y2 = [int(v) for v in content]
                 y1, y2 = [max(min(v, h-1), 0) for v in [y1, y2]]
@@ -113,9 +170,10 @@ def _draw_hwc(image: torch.Tensor, data: Dict[str, torch.Tensor]):
                 ]:
                     rr, cc, val = line_aa(yy1, xx1, yy2, xx2)
                     val = val[:, None][:, [0, 0, 0]]
-                    image[rr, cc] = image[rr, cc] * (1.0-val) + val * 255
+                    image_np[rr, cc] = image_np[rr, cc] * (1.0-val) + val * 255
 
         if tag == 'points':
+            image_np = as_numpy()
             for content in batch_content:
                 # content: npoints x 2
                 for x, y in content:
@@ -127,19 +185,27 @@ def _draw_hwc(image: torch.Tensor, data: Dict[str, torch.Tensor]):
                     cc = cc[valid]
                     val = val[valid]
                     val = val[:, None][:, [0, 0, 0]]
-                    image[rr, cc] = image[rr, cc] * (1.0-val) + val * 255
+                    image_np[rr, cc] = image_np[rr, cc] * (1.0-val) + val * 255
 
         if tag == 'seg':
+            image = as_tensor()
             label_names = batch_content['label_names']
-            for seg_logits in batch_content['logits']:
-                # content: nclasses x h x w
-                seg_probs = seg_logits.softmax(dim=0)
-                seg_labels = seg_probs.argmax(dim=0).cpu().numpy()
-                image = (_blend_labels(image.astype(np.float32) /
-                         255, seg_labels,
-                         label_names_dict=label_names) * 255).astype(dtype)
-
-    return torch.from_numpy(image).to(device=device)
+            crop_boxes = batch_content.get('crop_boxes')
+            for i, seg_labels in enumerate(_seg_label_maps(batch_content)):
+                seg_labels = seg_labels.to(device)
+                if crop_boxes is None:
+                    image = _blend_labels_lut(
+                        image, seg_labels, label_names_dict=label_names)
+                else:
+                    # crop-local label map, see FaRLFaceParser(crop_to_face)
+                    x1, y1, x2, y2 = [int(v) for v in crop_boxes[i]]
+                    image[y1:y2, x1:x2] = _blend_labels_lut(
+                        image[y1:y2, x1:x2], seg_labels,
+                        label_names_dict=label_names)
+
+    if image is None:
+        return torch.from_numpy(image_np).to(device=device)
+    return image
 
 
 def draw_bchw(images: torch.Tensor, data: Dict[str, torch.Tensor]) -> torch.Tensor:
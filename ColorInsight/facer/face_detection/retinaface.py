@@ -1,16 +1,17 @@
 # largely borrowed from https://github.dev/elliottzheng/batch-face/face_detection/alignment.py
 
 from typing import Dict, List, Optional, Tuple
-import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models._utils as _utils
+from torchvision.ops import batched_nms
 from .base import FaceDetector
+from ..model_store import get_model_store, load_state_dict
 
 
-from itertools import product as product
+import functools
 from math import ceil
 
 
@@ -328,35 +329,35 @@ def decode_landm(pre, priors, variances):
     return landms
 
 
-def py_cpu_nms(dets, thresh):
-    """Pure Python NMS baseline."""
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
-    scores = dets[:, 4]
+@functools.lru_cache(maxsize=32)
+def _prior_boxes(min_sizes: Tuple[Tuple[int, ...], ...], steps: Tuple[int, ...],
+                 clip: bool, image_size: Tuple[int, int],
+                 device: torch.device) -> torch.Tensor:
+    """ Anchors for one (image size, cfg, device), memoized.
 
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-
-        inds = np.where(ovr <= thresh)[0]
-        order = order[inds + 1]
-
-    return keep
+    Returns:
+        torch.Tensor: nanchors x 4 (cx, cy, s_kx, s_ky), ordered by feature map,
+            then row, column and min size.
+    """
+    im_h, im_w = image_size
+    anchors = []
+    for step, sizes in zip(steps, min_sizes):
+        f_h, f_w = ceil(im_h / step), ceil(im_w / step)
+        # float64 to reproduce the python float arithmetic exactly
+        cy = (torch.arange(f_h, dtype=torch.float64) + 0.5) * step / im_h
+        cx = (torch.arange(f_w, dtype=torch.float64) + 0.5) * step / im_w
+        sizes = torch.tensor(sizes, dtype=torch.float64)
+        shape = (f_h, f_w, len(sizes))
+        cy = cy.view(-1, 1, 1).expand(shape)
+        cx = cx.view(1, -1, 1).expand(shape)
+        s_kx = (sizes / im_w).view(1, 1, -1).expand(shape)
+        s_ky = (sizes / im_h).view(1, 1, -1).expand(shape)
+        anchors.append(torch.stack([cx, cy, s_kx, s_ky], dim=-1).reshape(-1, 4))
+
+    output = torch.cat(anchors, dim=0).float()
+    if clip:
+        output.clamp_(max=1, min=0)
+    return output.to(device)
 
 
 class PriorBox(object):
@@ -372,28 +373,11 @@ class PriorBox(object):
         ]
         self.name = "s"
 
-    def forward(self):
-        anchors = []
-        for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [
-                        x * self.steps[k] / self.image_size[1] for x in [j + 0.5]
-                    ]
-                    dense_cy = [
-                        y * self.steps[k] / self.image_size[0] for y in [i + 0.5]
-                    ]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
-
-        # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
-        if self.clip:
-            output.clamp_(max=1, min=0)
-        return output
+    def forward(self, device=None):
+        """ The returned tensor is cached and shared, do not modify it in place. """
+        return _prior_boxes(
+            tuple(tuple(sizes) for sizes in self.min_sizes), tuple(self.steps),
+            self.clip, tuple(self.image_size), torch.device(device or 'cpu'))
 
 
 cfg_mnet = {
@@ -452,7 +436,17 @@ def remove_prefix(state_dict, prefix):
 
 
 def load_model(model, pretrained_path, load_to_cpu, network: str):
-    if pretrained_path is None:
+    store = get_model_store()
+    if pretrained_path is None and store is not None:
+        # local store: verified, memory-mapped and no network when populated
+        pretrained_path = store.fetch(pretrained_urls[network])
+        if load_to_cpu:
+            pretrained_dict = load_state_dict(pretrained_path)
+        else:
+            pretrained_dict = load_state_dict(
+                pretrained_path, map_location=torch.device(
+                    'cuda', torch.cuda.current_device()))
+    elif pretrained_path is None:
         url = pretrained_urls[network]
         if load_to_cpu:
             pretrained_dict = torch.utils.model_zoo.load_url(
@@ -499,14 +493,7 @@ def load_net(model_path, network="mobilenet"):
     return net
 
 
-def parse_det(det) -> Tuple[torch.Tensor, torch.Tensor, float]:
-    landmarks = det[5:].reshape(5, 2)
-    box = det[:4]
-    score = det[4]
-    return torch.from_numpy(box), torch.from_numpy(landmarks), score
-
-
-def post_process(
+def batch_post_process(
     loc,
     conf,
     landms,
@@ -519,63 +506,86 @@ def post_process(
     top_k,
     nms_threshold,
     keep_top_k,
+    largest_first=False,
 ):
-    boxes = decode(loc, prior_data, cfg["variance"])
-    boxes = boxes * scale / resize
-    boxes = boxes.cpu().numpy()
-    scores = conf.cpu().numpy()[:, 1]
-    landms_copy = decode_landm(landms, prior_data, cfg["variance"])
-
-    landms_copy = landms_copy * scale1 / resize
-    landms_copy = landms_copy.cpu().numpy()
+    """ Post-process a whole batch of raw predictions without leaving the device.
 
-    # ignore low scores
-    inds = np.where(scores > confidence_threshold)[0]
-    boxes = boxes[inds]
-    landms_copy = landms_copy[inds]
-    scores = scores[inds]
-
-    # keep top-K before NMS
-    order = scores.argsort()[::-1][:top_k]
-    boxes = boxes[order]
-    landms_copy = landms_copy[order]
-    scores = scores[order]
+    Args:
+        loc: b x nanchors x 4
+        conf: b x nanchors x 2
+        landms: b x nanchors x 10
+        largest_first: Order the detections of each image by decreasing box
+            area instead of score, so `keep_top_k` keeps the largest faces.
 
-    # do NMS
-    dets = np.hstack((boxes, scores[:, np.newaxis])).astype(
-        np.float32, copy=False)
-    keep = py_cpu_nms(dets, nms_threshold)
-    # keep = nms(dets, args.nms_threshold,force_cpu=args.cpu)
-    dets = dets[keep, :]
-    landms_copy = landms_copy[keep]
+    Returns:
+        Tuple of rects (n x 4), points (n x 5 x 2), scores (n) and image_ids (n).
+        Detections are grouped by image and sorted by decreasing score (or
+        area) within each image.
+    """
+    batch_size, num_anchors = conf.shape[:2]
+    device = conf.device
+
+    # keep top-K before NMS, then ignore low scores. `topk` returns sorted
+    # scores, so the ones above the threshold are a prefix of each row.
+    top_scores, top_anchors = conf[:, :, 1].topk(min(top_k, num_anchors), dim=1)
+    valid = top_scores > confidence_threshold
+    image_ids = torch.arange(batch_size, device=device).unsqueeze(
+        1).expand_as(top_anchors)[valid]
+    anchor_ids = top_anchors[valid]
+    scores = top_scores[valid]
+
+    # only the surviving candidates are decoded
+    priors = prior_data[anchor_ids]
+    boxes = decode(loc[image_ids, anchor_ids], priors, cfg["variance"])
+    boxes = boxes * scale / resize
+    landms = decode_landm(landms[image_ids, anchor_ids], priors, cfg["variance"])
+    landms = landms * scale1 / resize
 
-    # keep top-K faster NMS
-    dets = dets[:keep_top_k, :]
-    landms_copy = landms_copy[:keep_top_k, :]
+    # do NMS, independently per image; the result is sorted by decreasing score
+    keep = batched_nms(boxes, scores, image_ids, nms_threshold)
+    if largest_first:
+        kept_boxes = boxes[keep]
+        area = (kept_boxes[:, 2] - kept_boxes[:, 0]) * \
+            (kept_boxes[:, 3] - kept_boxes[:, 1])
+        keep = keep[torch.sort(area, descending=True, stable=True).indices]
+    # group by image while preserving the score (or area) order
+    keep = keep[torch.sort(image_ids[keep], stable=True).indices]
 
-    dets = np.concatenate((dets, landms_copy), axis=1)
-    # show image
-    dets = sorted(dets, key=lambda x: x[4], reverse=True)
-    dets = [parse_det(x) for x in dets]
+    # keep top-K after NMS, per image
+    kept_ids = image_ids[keep]
+    counts = torch.bincount(kept_ids, minlength=batch_size)
+    starts = torch.cumsum(counts, dim=0) - counts
+    rank = torch.arange(kept_ids.numel(), device=device) - starts[kept_ids]
+    keep = keep[rank < keep_top_k]
 
-    return dets
+    return boxes[keep], landms[keep].reshape(-1, 5, 2), scores[keep], image_ids[keep]
 
 
 @torch.no_grad()
-def batch_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5):
+def batch_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5,
+                 target_size: Optional[int] = None, max_faces: Optional[int] = None,
+                 largest_face: bool = False):
     """
     Args:
         net:
         images: b x 3(rgb) x h x w, 0-255, uint8
+        target_size: If given, images whose long side is larger are downscaled
+            so that it equals `target_size` before running the network.
+            Coordinates are always returned in the original resolution.
+        max_faces: Maximum number of faces kept per image.
+        largest_face: Rank faces by box area instead of score (combine with
+            `max_faces=1` to keep only the largest face).
 
     Returns:
-
+        Dict with rects (n x 4), points (n x 5 x 2), scores (n) and
+        image_ids (n, int64). When no face passes the threshold these are
+        empty tensors with the same trailing shapes.
     """
     confidence_threshold = threshold
     cfg = cfg_mnet
     top_k = 5000
     nms_threshold = 0.4
-    keep_top_k = 750
+    keep_top_k = 750 if max_faces is None else max_faces
     resize = 1
     # if not is_tensor:
     #     try:
@@ -586,6 +596,20 @@ def batch_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5):
     # else:
     #
     img = images.float()
+    # predictions are normalized to the network input, so the original size
+    # is used to scale them back
+    (
+        _,
+        _,
+        im_height,
+        im_width,
+    ) = img.shape
+    if target_size is not None and max(im_height, im_width) > target_size:
+        ratio = target_size / max(im_height, im_width)
+        # antialias: without it large downscales alias and small faces are missed
+        img = F.interpolate(
+            img, size=(max(1, round(im_height * ratio)), max(1, round(im_width * ratio))),
+            mode='bilinear', align_corners=False, antialias=True)
     # img = img.to(device)
     # if cv:
     # img = img[..., [2, 1, 0]]
@@ -594,12 +618,6 @@ def batch_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5):
     )
     img -= mean
     # img = img.permute(0, 3, 1, 2)
-    (
-        _,
-        _,
-        im_height,
-        im_width,
-    ) = img.shape
     scale = torch.as_tensor(
         [im_width, im_height, im_width, im_height],
         dtype=img.dtype,
@@ -609,63 +627,48 @@ def batch_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5):
 
     loc, conf, landms = net(img)  # forward pass
 
-    priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-    priors = priorbox.forward()
-    prior_data = priors.to(img.device)
+    # anchors follow the (possibly downscaled) network input
+    priorbox = PriorBox(cfg, image_size=(img.shape[2], img.shape[3]))
+    prior_data = priorbox.forward(img.device)
     scale1 = torch.as_tensor(
         [
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
+            im_width,
+            im_height,
+            im_width,
+            im_height,
+            im_width,
+            im_height,
+            im_width,
+            im_height,
+            im_width,
+            im_height,
         ],
         dtype=img.dtype,
         device=img.device,
     )
     scale1 = scale1.to(img.device)
 
-    all_dets = [
-        post_process(
-            loc_i,
-            conf_i,
-            landms_i,
-            prior_data,
-            cfg,
-            scale,
-            scale1,
-            resize,
-            confidence_threshold,
-            top_k,
-            nms_threshold,
-            keep_top_k,
-        )
-        for loc_i, conf_i, landms_i in zip(loc, conf, landms)
-    ]
-
-    # print(all_dets)
-
-    rects = []
-    points = []
-    scores = []
-    image_ids = []
-    for image_id, faces_in_one_image in enumerate(all_dets):
-        for rect, landmarks, score in faces_in_one_image:
-            rects.append(rect)
-            points.append(landmarks)
-            scores.append(score)
-            image_ids.append(image_id)
+    rects, points, scores, image_ids = batch_post_process(
+        loc,
+        conf,
+        landms,
+        prior_data,
+        cfg,
+        scale,
+        scale1,
+        resize,
+        confidence_threshold,
+        top_k,
+        nms_threshold,
+        keep_top_k,
+        largest_first=largest_face,
+    )
 
     return {
-        'rects': torch.stack(rects, dim=0).to(img.device),
-        'points': torch.stack(points, dim=0).to(img.device),
-        'scores': torch.tensor(scores).to(img.device),
-        'image_ids': torch.tensor(image_ids).to(img.device)
+        'rects': rects,
+        'points': points,
+        'scores': scores,
+        'image_ids': image_ids
     }
 
 
@@ -673,6 +676,15 @@ class RetinaFaceDetector(FaceDetector):
     """RetinaFaceDetector
 
     Args:
+        conf_name (str): 'mobilenet' or 'resnet50'.
+        model_path (str): Optional local weights, downloaded otherwise.
+        target_size (int): Downscale inputs whose long side exceeds this
+            before detection. Coordinates are returned in the input resolution.
+        max_faces (int): Maximum number of faces kept per image.
+        largest_face (bool): Keep the largest faces first instead of the most
+            confident ones.
+
+    Forward Args:
         images (torch.Tensor): b x c x h x w
 
     Returns:
@@ -685,12 +697,21 @@ class RetinaFaceDetector(FaceDetector):
     """
 
     def __init__(self, conf_name: Optional[str] = None,
-                 model_path: Optional[str] = None) -> None:
+                 model_path: Optional[str] = None,
+                 target_size: Optional[int] = None,
+                 max_faces: Optional[int] = None,
+                 largest_face: bool = False) -> None:
         super().__init__()
         if conf_name is None:
             conf_name = 'mobilenet'
         self.net = load_net(model_path, conf_name)
+        self.target_size = target_size
+        self.max_faces = max_faces
+        self.largest_face = largest_face
         self.eval()
 
     def forward(self, images: torch.Tensor) -> Dict[str, torch.Tensor]:
-        return batch_detect(self.net, images, threshold=0.8)
+        return batch_detect(self.net, images, threshold=0.8,
+                            target_size=self.target_size,
+                            max_faces=self.max_faces,
+                            largest_face=self.largest_face)
@@ -23,5 +23,10 @@ class FaceParser(nn.Module):
 
                 * logits (torch.Tensor): nfaces x nclasses x h x w
                 * label_names (List[str]): nclasses
+
+                or, for parsers producing label maps:
+
+                * labels (torch.Tensor): nfaces x h x w, uint8
+                * masks (Dict[str, torch.Tensor]): nfaces x h x w, bool
     """
     pass
\ No newline at end of file
@@ -1,4 +1,4 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import functools
 import torch
 import torch.nn.functional as F
@@ -8,6 +8,9 @@ from ..transform import (get_crop_and_resize_matrix, get_face_align_matrix,
                          make_inverted_tanh_warp_grid, make_tanh_warp_grid)
 from .base import FaceParser
 
+# Granularity of the crop windows of `crop_to_face`
+CROP_SIZE_STEP = 64
+
 pretrain_settings = {
     'lapa/448': {
         'url': [
@@ -43,17 +46,84 @@ class FaRLFaceParser(FaceParser):
     """
 
     def __init__(self, conf_name: Optional[str] = None,
-                 model_path: Optional[str] = None, device=None) -> None:
+                 model_path: Optional[str] = None, device=None,
+                 crop_to_face: bool = False, crop_margin: float = 0.5,
+                 output: str = 'logits',
+                 masks: Optional[Dict[str, List[str]]] = None,
+                 mask_threshold: float = 0.5) -> None:
         super().__init__()
         if conf_name is None:
             conf_name = 'lapa/448'
         if model_path is None:
             model_path = pretrain_settings[conf_name]['url']
+        assert output in ('logits', 'labels')
         self.conf_name = conf_name
+        self.crop_to_face = crop_to_face
+        self.crop_margin = crop_margin
+        self.output = output
+        self.masks = masks
+        self.mask_threshold = mask_threshold
         self.net = download_jit(model_path, map_location=device)
         self.eval()
 
-    def forward(self, images: torch.Tensor, data: Dict[str, Any]):
+    def _crop_boxes(self, rects: torch.Tensor, h: int, w: int) -> torch.Tensor:
+        """ Windows of a common size around each face, clamped to the image.
+
+        The size is rounded up to a multiple of `CROP_SIZE_STEP`, so photos
+        with similar face sizes share the cached coordinate grids.
+
+        Returns:
+            torch.Tensor: nfaces x 4 (x1, y1, x2, y2), int64, x2/y2 exclusive.
+        """
+        sizes = (rects[:, 2:] - rects[:, :2]) * (1 + 2 * self.crop_margin)
+        sizes = (sizes / CROP_SIZE_STEP).ceil() * CROP_SIZE_STEP
+        crop_w = min(w, max(1, int(sizes[:, 0].max().item())))
+        crop_h = min(h, max(1, int(sizes[:, 1].max().item())))
+        centers = (rects[:, :2] + rects[:, 2:]) / 2
+        x1 = (centers[:, 0] - crop_w / 2).round().long().clamp(0, w - crop_w)
+        y1 = (centers[:, 1] - crop_h / 2).round().long().clamp(0, h - crop_h)
+        return torch.stack([x1, y1, x1 + crop_w, y1 + crop_h], dim=1)
+
+    def _labels_and_masks(self, seg_logits: torch.Tensor,
+                          masks: Optional[Dict[str, List[str]]]) -> Dict[str, Any]:
+        """ Reduce logits to uint8 labels and boolean masks on the device. """
+        label_names = pretrain_settings[self.conf_name]['label_names']
+        seg_probs = seg_logits.softmax(dim=1)  # nfaces x nclasses x h x w
+        result = {'labels': seg_probs.argmax(dim=1).to(torch.uint8),
+                  'masks': {}}
+        for mask_name, class_names in (masks or {}).items():
+            class_ids = [label_names.index(name) for name in class_names]
+            result['masks'][mask_name] = \
+                seg_probs[:, class_ids].sum(dim=1) >= self.mask_threshold
+        return result
+
+    def forward(self, images: torch.Tensor, data: Dict[str, Any],
+                crop_to_face: Optional[bool] = None,
+                output: Optional[str] = None,
+                masks: Optional[Dict[str, List[str]]] = None):
+        """
+        Args:
+            crop_to_face: Return logits only inside a window around each face
+                instead of over the whole image. The windows are stored in
+                `data['seg']['crop_boxes']` (nfaces x 4, x1, y1, x2, y2) and
+                all share the same size. Defaults to the constructor setting.
+            output: 'logits' stores float logits in `data['seg']['logits']`.
+                'labels' stores instead the argmax label map as uint8 in
+                `data['seg']['labels']` and, for each entry of `masks`, a
+                boolean map in `data['seg']['masks']`.
+            masks: Mapping from a mask name to the class names it covers,
+                e.g. `{'lips': ['ulip', 'llip']}`. A pixel is set when the
+                summed probability of those classes reaches `mask_threshold`.
+            Unset arguments default to the constructor settings.
+        """
+        if crop_to_face is None:
+            crop_to_face = self.crop_to_face
+        if output is None:
+            output = self.output
+        if masks is None:
+            masks = self.masks
+        # without faces there is no window to size the crops on
+        crop_to_face = crop_to_face and data['rects'].size(0) > 0
         setting = pretrain_settings[self.conf_name]
         images = images.float() / 255.0
         _, _, h, w = images.shape
@@ -61,7 +131,16 @@ class FaRLFaceParser(FaceParser):
         simages = images[data['image_ids']]
         matrix = setting['get_matrix_fn'](data[setting['matrix_src_tag']])
         grid = setting['get_grid_fn'](matrix=matrix, orig_shape=(h, w))
-        inv_grid = setting['get_inv_grid_fn'](matrix=matrix, orig_shape=(h, w))
+        if crop_to_face:
+            crop_boxes = self._crop_boxes(data['rects'], h, w)
+            crop_h = int(crop_boxes[0, 3] - crop_boxes[0, 1])
+            crop_w = int(crop_boxes[0, 2] - crop_boxes[0, 0])
+            # the inverse warp is only evaluated over the windows
+            inv_grid = setting['get_inv_grid_fn'](
+                matrix=matrix, orig_shape=(crop_h, crop_w),
+                offset_xy=crop_boxes[:, :2])
+        else:
+            inv_grid = setting['get_inv_grid_fn'](matrix=matrix, orig_shape=(h, w))
 
         w_images = F.grid_sample(
             simages, grid, mode='bilinear', align_corners=False)
@@ -71,6 +150,11 @@ class FaRLFaceParser(FaceParser):
         seg_logits = F.grid_sample(
             w_seg_logits, inv_grid, mode='bilinear', align_corners=False)
 
-        data['seg'] = {'logits': seg_logits,
-                       'label_names': setting['label_names']}
+        if output == 'labels':
+            data['seg'] = self._labels_and_masks(seg_logits, masks)
+        else:
+            data['seg'] = {'logits': seg_logits}
+        data['seg']['label_names'] = setting['label_names']
+        if crop_to_face:
+            data['seg']['crop_boxes'] = crop_boxes
         return data
@@ -1,6 +1,41 @@
+import io
+import os
+from typing import Optional, Tuple, Union
+
 import torch
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
+
+
+def decode_hwc(src: Union[str, os.PathLike, bytes, bytearray, memoryview],
+               max_size: Optional[int] = None) -> Tuple[torch.Tensor, np.ndarray]:
+    """Decode an image once into an RGB uint8 h x w x 3 array.
+
+    The EXIF orientation is applied, so the result is upright. When
+    `max_size` is given, JPEGs are decoded at the smallest DCT scale
+    (1/2, 1/4 or 1/8) whose longer side is still at least `max_size`;
+    the image is not resized any further.
+
+    Args:
+        src: A file path or the raw bytes of an encoded image.
+        max_size (Optional[int]): The longer side the caller needs.
+
+    Returns:
+        Tuple[torch.Tensor, np.ndarray]: The image as a tensor and as a
+            numpy array sharing the same memory.
+    """
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        src = io.BytesIO(src)
+    with Image.open(src) as image:
+        if max_size:
+            scale = max_size / max(image.size)
+            if scale < 1:
+                # only JPEG supports draft mode, other formats ignore it
+                image.draft('RGB', (int(np.ceil(image.size[0] * scale)),
+                                    int(np.ceil(image.size[1] * scale))))
+        image = ImageOps.exif_transpose(image)
+        np_image = np.array(image.convert('RGB'))
+    return torch.from_numpy(np_image), np_image
 
 
 def read_hwc(path: str) -> torch.Tensor:
@@ -9,9 +44,7 @@ def read_hwc(path: str) -> torch.Tensor:
     Args:
         path (str): The given path.
     """
-    image = Image.open(path)
-    np_image = np.array(image.convert('RGB'))
-    return torch.from_numpy(np_image)
+    return decode_hwc(path)[0]
 
 
 def write_hwc(image: torch.Tensor, path: str):
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import torch
+
+from .util import download_url_to_file
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def filename_from_url(url: str) -> str:
+    return os.path.basename(urlparse(url).path)
+
+
+class ModelStore:
+    """ A local directory of model weights with a SHA-256 manifest.
+
+    Files are looked up by the basename of their download url. Files listed
+    in `manifest.json` are verified (once per process) before being used.
+    When `offline` is set, missing files and files without a manifest entry
+    raise instead of being downloaded or loaded unverified.
+
+    Args:
+        root (str): The store directory.
+        offline (bool): Never attempt network downloads.
+    """
+
+    def __init__(self, root: str, offline: bool = False) -> None:
+        self.root = root
+        self.offline = offline
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    def manifest(self) -> Dict[str, str]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: Dict[str, str]):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def verify(self, filename: str) -> str:
+        """ Return the local path of `filename`, checking its hash if listed. """
+        path = os.path.join(self.root, filename)
+        with self._lock:
+            if filename in self._verified:
+                return path
+            expected = self.manifest().get(filename)
+            if expected is None:
+                if self.offline:
+                    raise RuntimeError(
+                        f'{path} has no entry in {self.manifest_path}; '
+                        'refusing to load an unverified file offline')
+                sys.stderr.write(f'Warning: {path} is not in {MANIFEST_NAME}, '
+                                 'loading it without an integrity check\n')
+            else:
+                actual = sha256_file(path)
+                if actual != expected:
+                    raise RuntimeError(
+                        f'checksum mismatch for {path}: expected {expected}, got {actual}')
+            self._verified.add(filename)
+        return path
+
+    def add(self, filename: str) -> str:
+        """ Record the hash of a file already copied into the store. """
+        path = os.path.join(self.root, filename)
+        digest = sha256_file(path)
+        with self._lock:
+            manifest = self.manifest()
+            manifest[filename] = digest
+            self._write_manifest(manifest)
+            self._verified.add(filename)
+        return digest
+
+    def resolve(self, url: str) -> Optional[str]:
+        """ Local path for `url`, or None if it is not in the store. """
+        filename = filename_from_url(url)
+        if not os.path.exists(os.path.join(self.root, filename)):
+            return None
+        return self.verify(filename)
+
+    def fetch(self, url: str) -> str:
+        """ Local path for `url`, downloading it into the store if needed. """
+        path = self.resolve(url)
+        if path is not None:
+            return path
+        if self.offline:
+            raise RuntimeError(
+                f'{filename_from_url(url)} is not in the offline model store {self.root}')
+        os.makedirs(self.root, exist_ok=True)
+        filename = filename_from_url(url)
+        path = os.path.join(self.root, filename)
+        sys.stderr.write('Downloading: "{}" to {}\n'.format(url, path))
+        download_url_to_file(url, path)
+        self.add(filename)
+        return path
+
+
+_store: Optional[ModelStore] = None
+
+
+def get_model_store() -> Optional[ModelStore]:
+    """ The configured store, from `set_model_store` or the environment.
+
+    `FACER_MODEL_DIR` sets the directory and `FACER_OFFLINE=1` forbids
+    downloads. Returns None when no store is configured.
+    """
+    global _store
+    if _store is None and os.environ.get('FACER_MODEL_DIR'):
+        _store = ModelStore(os.environ['FACER_MODEL_DIR'],
+                            offline=os.environ.get('FACER_OFFLINE', '0') == '1')
+    return _store
+
+
+def set_model_store(store: Optional[ModelStore]):
+    global _store
+    _store = store
+
+
+def load_state_dict(path: str, map_location=None):
+    """ Load a checkpoint, memory-mapping it when the torch version allows. """
+    if map_location is None:
+        map_location = 'cpu'
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch without `mmap`, or a legacy (non-zip) checkpoint
+        return torch.load(path, map_location=map_location)
+
+
+def known_urls() -> Dict[str, str]:
+    """ Download urls of every pretrained model facer knows about. """
+    from .face_detection.retinaface import pretrained_urls
+    from .face_parsing.farl import pretrain_settings
+    urls = {f'retinaface/{name}': url for name, url in pretrained_urls.items()}
+    for conf_name, setting in pretrain_settings.items():
+        urls[f'farl/{conf_name}'] = setting['url'][0]
+    return urls
+
+
+def main():
+    """ Populate a store for offline use: `python -m facer.model_store DIR` """
+    if len(sys.argv) != 2:
+        print('usage: python -m facer.model_store <directory>')
+        sys.exit(1)
+    store = ModelStore(sys.argv[1])
+    for name, url in known_urls().items():
+        path = store.fetch(url)
+        filename = filename_from_url(url)
+        digest = store.manifest().get(filename) or store.add(filename)
+        print(f'{name}: {path} {digest}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@ from typing import List, Dict, Callable, Tuple, Optional
 import torch
 import torch.nn.functional as F
 import functools
+import threading
+from collections import OrderedDict
 
 
 def get_crop_and_resize_matrix(
@@ -146,16 +148,136 @@ def get_face_align_matrix(
     return get_similarity_transform_matrix(face_pts, target_pts)
 
 
-@functools.lru_cache(maxsize=128)
-def _meshgrid(h, w) -> Tuple[torch.Tensor, torch.Tensor]:
-    yy, xx = torch.meshgrid(torch.arange(h).float(),
-                            torch.arange(w).float())
-    return yy, xx
+# Bytes of meshgrids kept by `_base_coords`, least recently used evicted first
+BASE_COORDS_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class _BaseCoordsCache:
+    """ LRU of pixel meshgrids keyed by (h, w, device), bounded in bytes. """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._coords = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, h: int, w: int, device: torch.device) -> torch.Tensor:
+        key = (h, w, device)
+        with self._lock:
+            coords = self._coords.get(key)
+            if coords is not None:
+                self._coords.move_to_end(key)
+                self.hits += 1
+                return coords
+            self.misses += 1
+
+        yy, xx = torch.meshgrid(torch.arange(h, device=device).float(),
+                                torch.arange(w, device=device).float(),
+                                indexing='ij')
+        coords = torch.stack([xx, yy], dim=-1).reshape(1, h*w, 2)
+
+        nbytes = coords.numel() * coords.element_size()
+        with self._lock:
+            if key not in self._coords and nbytes <= self.max_bytes:
+                self._coords[key] = coords
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, old = self._coords.popitem(last=False)
+                    self.nbytes -= old.numel() * old.element_size()
+        return coords
+
+    def info(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._coords), 'bytes': self.nbytes}
+
+
+_base_coords_cache = _BaseCoordsCache(BASE_COORDS_CACHE_BYTES)
+
+
+def _base_coords(h: int, w: int, device: torch.device) -> torch.Tensor:
+    """ Pixel coordinates of an h x w grid, already on `device`.
+
+    Returns:
+        torch.Tensor: 1 x (h x w) x 2 (x, y). Shared, do not modify in place.
+    """
+    return _base_coords_cache(h, w, device)
+
+
+class _GridCache:
+    """ LRU cache of warp grids keyed by the exact alignment matrix.
+
+    Disabled (`maxsize=0`) by default. Enable it with `set_grid_cache` when
+    consecutive calls are expected to reuse the same alignment, e.g. repeated
+    frames of a still subject.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._grids: 'OrderedDict[tuple, torch.Tensor]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, make_key: Callable[[], tuple],
+                     build: Callable[[], torch.Tensor]) -> torch.Tensor:
+        if self.maxsize <= 0:
+            return build()
+        # the key copies the matrix to the host, so it is only built when enabled
+        key = make_key()
+        with self._lock:
+            grid = self._grids.get(key)
+            if grid is not None:
+                self._grids.move_to_end(key)
+                self.hits += 1
+                return grid
+            self.misses += 1
+        grid = build()
+        with self._lock:
+            self._grids[key] = grid
+            while len(self._grids) > self.maxsize:
+                self._grids.popitem(last=False)
+        return grid
+
+    def clear(self):
+        with self._lock:
+            self._grids.clear()
+            self.hits = self.misses = 0
+
+
+_grid_cache = _GridCache()
+
+
+def set_grid_cache(maxsize: int):
+    """ Keep up to `maxsize` warp grids keyed by alignment matrix (0 disables). """
+    _grid_cache.maxsize = maxsize
+    if maxsize <= 0:
+        _grid_cache.clear()
+
+
+def grid_cache_info() -> Dict[str, Dict[str, int]]:
+    """ Hit/miss counters of the base meshgrid cache and of the grid cache. """
+    return {
+        'base_coords': _base_coords_cache.info(),
+        'grids': {'hits': _grid_cache.hits, 'misses': _grid_cache.misses,
+                  'size': len(_grid_cache._grids)},
+    }
+
+
+def _grid_key(kind: str, matrix: torch.Tensor, warp_factor: float,
+              warped_shape: Tuple[int, int], orig_shape: Tuple[int, int],
+              offset_xy: Optional[torch.Tensor] = None) -> tuple:
+    offset = None if offset_xy is None else offset_xy.cpu().numpy().tobytes()
+    return (kind, str(matrix.device), matrix.dtype, tuple(matrix.shape),
+            matrix.detach().cpu().numpy().tobytes(), warp_factor,
+            tuple(warped_shape[:2]), tuple(orig_shape[:2]), offset)
 
 
 def _forge_grid(batch_size: int, device: torch.device,
                 output_shape: Tuple[int, int],
-                fn: Callable[[torch.Tensor], torch.Tensor]
+                fn: Callable[[torch.Tensor], torch.Tensor],
+                offset_xy: Optional[torch.Tensor] = None
                 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """ Forge transform maps with a given function `fn`.
 
@@ -164,6 +286,9 @@ def _forge_grid(batch_size: int, device: torch.device,
         fn (Callable[[torch.Tensor], torch.Tensor]): The function that accepts 
             a bxnx2 array and outputs the transformed bxnx2 array. Both input 
             and output store (x, y) coordinates.
+        offset_xy (torch.Tensor): Optional b x 2 (x, y) offsets added to the 
+            coordinates before `fn`, so the map covers a window of a larger 
+            image whose top-left corner is at `offset_xy`.
 
     Note: 
         both input and output arrays of `fn` should store (y, x) coordinates.
@@ -174,12 +299,10 @@ def _forge_grid(batch_size: int, device: torch.device,
             `(X[y, x], Y[y, x]) = fn([x, y])`
     """
     h, w, *_ = output_shape
-    yy, xx = _meshgrid(h, w)  # h x w
-    yy = yy.unsqueeze(0).broadcast_to(batch_size, h, w).to(device)
-    xx = xx.unsqueeze(0).broadcast_to(batch_size, h, w).to(device)
-
-    in_xxyy = torch.stack(
-        [xx, yy], dim=-1).reshape([batch_size, h*w, 2])  # (h x w) x 2
+    in_xxyy = _base_coords(h, w, torch.device(device)).broadcast_to(
+        batch_size, h*w, 2)  # b x (h x w) x 2
+    if offset_xy is not None:
+        in_xxyy = in_xxyy + offset_xy.to(in_xxyy).reshape(batch_size, 1, 2)
     out_xxyy: torch.Tensor = fn(in_xxyy)  # (h x w) x 2
     return out_xxyy.reshape(batch_size, h, w, 2)
 
@@ -308,35 +431,44 @@ def make_tanh_warp_grid(matrix: torch.Tensor, warp_factor: float,
     """
     orig_h, orig_w, *_ = orig_shape
     w_h = torch.tensor([orig_w, orig_h]).to(matrix).reshape(1, 1, 1, 2)
-    return _forge_grid(
-        matrix.size(0), matrix.device,
-        warped_shape,
-        functools.partial(inverted_tanh_warp_transform,
-                          matrix=matrix,
-                          warp_factor=warp_factor,
-                          warped_shape=warped_shape)) / w_h*2-1
+    return _grid_cache.get_or_build(
+        lambda: _grid_key('tanh', matrix, warp_factor, warped_shape, orig_shape),
+        lambda: _forge_grid(
+            matrix.size(0), matrix.device,
+            warped_shape,
+            functools.partial(inverted_tanh_warp_transform,
+                              matrix=matrix,
+                              warp_factor=warp_factor,
+                              warped_shape=warped_shape)) / w_h*2-1)
 
 
 def make_inverted_tanh_warp_grid(matrix: torch.Tensor, warp_factor: float,
                                  warped_shape: Tuple[int, int],
-                                 orig_shape: Tuple[int, int]):
+                                 orig_shape: Tuple[int, int],
+                                 offset_xy: Optional[torch.Tensor] = None):
     """
     Args:
         matrix: bx4x4 matrix.
         warp_factor: The warping factor. `warp_factor=1.0` represents a vannila Tanh-warping, 
            `warp_factor=0.0` represents a cropping.
         warped_shape: The target image shape to transform to.
-        orig_shape: The original image shape that is transformed from.
+        orig_shape: The original image shape that is transformed from. With 
+            `offset_xy`, the shape of the window of the original image.
+        offset_xy: Optional b x 2 (x, y) top-left corners of the windows.
 
     Returns:
         torch.Tensor: b x h x w x 2 (x, y).
     """
     h, w, *_ = warped_shape
     w_h = torch.tensor([w, h]).to(matrix).reshape(1, 1, 1, 2)
-    return _forge_grid(
-        matrix.size(0), matrix.device,
-        orig_shape,
-        functools.partial(tanh_warp_transform,
-                          matrix=matrix,
-                          warp_factor=warp_factor,
-                          warped_shape=warped_shape)) / w_h * 2-1
+    return _grid_cache.get_or_build(
+        lambda: _grid_key('inv_tanh', matrix, warp_factor, warped_shape,
+                          orig_shape, offset_xy),
+        lambda: _forge_grid(
+            matrix.size(0), matrix.device,
+            orig_shape,
+            functools.partial(tanh_warp_transform,
+                              matrix=matrix,
+                              warp_factor=warp_factor,
+                              warped_shape=warped_shape),
+            offset_xy=offset_xy) / w_h * 2-1)
@@ -115,9 +115,15 @@ def download_jit(url_or_paths: Union[str, List[str]], model_dir=None, map_locati
     if isinstance(url_or_paths, str):
         url_or_paths = [url_or_paths]
 
+    from .model_store import get_model_store
+    store = get_model_store() if model_dir is None else None
+
     for url_or_path in url_or_paths:
         try:
-            if validators.url(url_or_path):
+            if validators.url(url_or_path) and store is not None:
+                # local store: verified, and no network access when populated
+                cached_file = store.fetch(url_or_path)
+            elif validators.url(url_or_path):
                 url = url_or_path
                 if model_dir is None:
                     if hasattr(torch.hub, 'get_dir'):
@@ -3,118 +3,424 @@ import glob
 import os
 import os.path as osp
 import random
+import threading
+import time
 from collections import Counter
 
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 from PIL import Image
 from skimage.filters import gaussian
 
 import facer
+import palette
+import result_cache
+import skin_model
+import telemetry
+from model_registry import classifier_version, get_registry
+from batching import BatchScheduler
 # from model import BiSeNet  # File not found - commented out
 
 
-def get_rgb_codes(path):
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    image = facer.hwc2bchw(facer.read_hwc(path)).to(device=device)
-    face_detector = facer.face_detector('retinaface/mobilenet', device=device)
-    with torch.inference_mode():
-        faces = face_detector(image)
+def load_image(src, max_size=None):
+    """Decode an image into an h x w x 3 RGB uint8 array.
+
+    `src` may be a file path, the raw bytes of an encoded image or an
+    already decoded RGB array (returned as is). Files are decoded once,
+    upright according to their EXIF orientation. JPEGs larger than
+    `max_size` (default COLORINSIGHT_DECODE_SIZE, 0 = full resolution) are
+    decoded directly at a reduced scale.
+    """
+    if isinstance(src, np.ndarray):
+        return src
+    if max_size is None:
+        max_size = int(os.environ.get('COLORINSIGHT_DECODE_SIZE', '0'))
+    with telemetry.span('decode'):
+        return facer.decode_hwc(src, max_size=max_size or None)[1]
+
+
+def letterbox(imgs):
+    """Stack RGB arrays of different sizes into one b x 3 x H x W batch.
+
+    Images are zero-padded on the bottom/right to the largest height and
+    width, so pixel coordinates inside each image are left unchanged.
+    """
+    height = max(img.shape[0] for img in imgs)
+    width = max(img.shape[1] for img in imgs)
+    batch = torch.zeros(len(imgs), height, width, 3, dtype=torch.uint8)
+    for i, img in enumerate(imgs):
+        batch[i, :img.shape[0], :img.shape[1]] = torch.from_numpy(img)
+    return batch.permute(0, 3, 1, 2)
+
+
+def _analysis_from_masks(img, skin, lips, x1=0, y1=0):
+    # skin, lips: ch x cw boolean numpy masks for a single face, covering
+    # the window of img whose top-left corner is (x1, y1)
+    h, w = img.shape[:2]
+    skin = skin[:h - y1, :w - x1]  # drop any letterbox padding
+    lips = lips[:h - y1, :w - x1]
+    ch, cw = skin.shape
+
+    skin_mask = np.zeros((h, w), dtype=bool)
+    skin_mask[y1:y1 + ch, x1:x1 + cw] = skin
+
+    indices = np.argwhere(lips)   #binary mask location extraction
+    rgb_codes = img[indices[:, 0] + y1, indices[:, 1] + x1, :] #RGB color extraction by pixels
+
+    return {
+        'image': img,
+        'face_found': True,
+        'skin_mask': skin_mask,
+        'lip_rgb_codes': rgb_codes,
+    }
+
+
+def _no_face_analysis(img):
+    return {
+        'image': img,
+        'face_found': False,
+        'skin_mask': None,
+        'lip_rgb_codes': np.zeros((0, 3), dtype=img.dtype),
+    }
+
+
+def _detect_each_at_own_scale(detector, imgs, device):
+    """Detect faces in images of different sizes as one batch.
+
+    Each image is downscaled to the detector's `target_size` on its own
+    before letterboxing, so its detections do not depend on the size of the
+    other images in the batch. Boxes and landmarks are mapped back to each
+    image's resolution.
+    """
+    target_size = getattr(detector, 'target_size', None)
+    resized, scales = [], []
+    for img in imgs:
+        h, w = img.shape[:2]
+        image = torch.from_numpy(img).to(device).permute(2, 0, 1)[None].float()
+        if target_size is not None and max(h, w) > target_size:
+            # same rounding and filter as the detector applies to a single image
+            ratio = target_size / max(h, w)
+            size = (max(1, round(h * ratio)), max(1, round(w * ratio)))
+            image = F.interpolate(image, size=size, mode='bilinear',
+                                  align_corners=False, antialias=True)
+        resized.append(image[0])
+        scales.append((w / image.shape[3], h / image.shape[2]))
+
+    height = max(image.shape[1] for image in resized)
+    width = max(image.shape[2] for image in resized)
+    batch = torch.zeros(len(resized), 3, height, width, device=device)
+    for i, image in enumerate(resized):
+        batch[i, :, :image.shape[1], :image.shape[2]] = image
+
+    faces = detector(batch)
+    scales = torch.tensor(scales, dtype=faces['rects'].dtype, device=device)
+    scale = scales[faces['image_ids']]  # nfaces x 2 (x, y)
+    faces['rects'] = faces['rects'] * scale.repeat(1, 2)
+    faces['points'] = faces['points'] * scale[:, None, :]
+    return faces
+
+
+def analyze_faces(imgs):
+    """Run detection and parsing on a list of decoded RGB arrays at once.
+
+    Returns one analysis dict per image (see `analyze_face`). Images where no
+    face is detected get `face_found=False`; if no image of the batch has a
+    face the parser is not run at all.
+    """
+    registry = get_registry()
+    if len(imgs) == 1:
+        image = facer.hwc2bchw(torch.from_numpy(imgs[0]))  # image: 1 x 3 x h x w
+    else:
+        image = letterbox(imgs)
+    image = image.to(device=registry.device)
 
-    face_parser = facer.face_parser('farl/lapa/448', device=device)
     with torch.inference_mode():
-        faces = face_parser(image, faces)
+        with telemetry.span('detect', registry.device):
+            if len(imgs) == 1:
+                faces = registry.detector()(image)
+            else:
+                faces = _detect_each_at_own_scale(registry.detector(), imgs, registry.device)
+        if faces['image_ids'].numel() == 0:
+            return [_no_face_analysis(img) for img in imgs]
+        with telemetry.span('parse', registry.device):
+            faces = registry.parser()(image, faces)
+
+    with telemetry.span('mask'):
+        # detections come grouped by image, largest face first (the registry's
+        # detector keeps a single face per image)
+        image_ids = faces['image_ids'].tolist()
+        crop_boxes = faces['seg']['crop_boxes'].tolist()
+        # the parser thresholds on device; only 1 byte per pixel reaches the CPU
+        skin_masks = faces['seg']['masks']['skin'].cpu().numpy()  # nfaces x ch x cw
+        lip_masks = faces['seg']['masks']['lips'].cpu().numpy()
+
+        results = []
+        for i, img in enumerate(imgs):
+            if i not in image_ids:
+                results.append(_no_face_analysis(img))
+                continue
+            face = image_ids.index(i)
+            x1, y1, _, _ = crop_boxes[face]
+            results.append(_analysis_from_masks(img, skin_masks[face], lip_masks[face], x1, y1))
+    return results
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def _get_batcher():
+    global _batcher
+    max_batch_size = int(os.environ.get('COLORINSIGHT_BATCH_SIZE', '1'))
+    if max_batch_size <= 1:
+        return None
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = BatchScheduler(
+                    analyze_faces, max_batch_size=max_batch_size,
+                    max_wait_ms=float(os.environ.get('COLORINSIGHT_BATCH_WAIT_MS', '5')))
+    return _batcher
+
+
+def analyze_face(image):
+    """Decode, detect and parse an image once.
+
+    `image` is anything accepted by `load_image`. Returns a dict with the
+    decoded RGB image, the face-skin binary mask and the RGB codes of the
+    lip pixels, so skin and lip analysis share a single forward pass of the
+    detector and of the parser. When no face is detected `face_found` is
+    False, `skin_mask` is None and `lip_rgb_codes` is empty.
+
+    When COLORINSIGHT_BATCH_SIZE > 1 the request is micro-batched with
+    other concurrent calls.
+    """
+    img = load_image(image)  # h x w x 3, RGB uint8
+    batcher = _get_batcher()
+    if batcher is not None:
+        return batcher.run(img)
+
+    return analyze_faces([img])[0]
 
-    seg_logits = faces['seg']['logits']
-    seg_probs = seg_logits.softmax(dim=1)  # nfaces x nclasses x h x w
-    seg_probs = seg_probs.cpu() #if you are using GPU
 
-    tensor = seg_probs.permute(0, 2, 3, 1)
-    tensor = tensor.squeeze().numpy()
+def _content(src):
+    """Bytes that identify an image for the result cache"""
+    if isinstance(src, np.ndarray):
+        array = np.ascontiguousarray(src)
+        return str(array.shape).encode() + array.tobytes()
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return src
+    with open(src, 'rb') as fp:
+        return fp.read()
 
-    llip = tensor[:, :, 7]
-    ulip = tensor[:,:,9]
-    lips = llip+ulip
-    binary_mask = (lips >= 0.5).astype(int)
 
-    sample = cv2.imread(path)
-    img = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
+# Parts of `analyze_colors`, cached separately, and their result fields
+COLOR_PARTS = {'skin': 'skin_probs', 'lips': 'lips'}
 
-    indices = np.argwhere(binary_mask)   #binary mask location extraction
-    rgb_codes = img[indices[:, 0], indices[:, 1], :] #RGB color extraction by pixels
-    return rgb_codes
 
-def filter_lip_random(rgb_codes,randomNum=40):
+def _part_key(key, part):
+    """Cache key of one part of an image, or None if it cannot be cached.
+
+    Skin results also depend on the classifier weights, so without them the
+    skin part is not cached.
+    """
+    if part != 'skin':
+        return f'{key}:{part}'
+    weights = classifier_version()
+    return None if weights is None else f'{key}:{part}:{weights}'
+
+
+def cache_key(src):
+    """The result cache key of `src`, or None when the cache is disabled."""
+    cache = result_cache.get_cache()
+    if cache is None:
+        return None
+    return cache.key(_content(src))
+
+
+def is_cached(key, parts=tuple(COLOR_PARTS)):
+    """Whether every part of `parts` is cached under `key`.
+
+    Unlike `analyze_colors` this does not count as a cache hit or miss.
+    """
+    cache = result_cache.get_cache()
+    if cache is None or key is None:
+        return False
+    part_keys = [_part_key(key, part) for part in parts]
+    return all(k is not None and cache.contains(k) for k in part_keys)
+
+
+def analyze_colors(src, parts=tuple(COLOR_PARTS), image=None, mask_path=None,
+                   timing=None, key=None):
+    """Skin season probabilities and/or lip color summary of an image.
+
+    `src` is anything accepted by `load_image`. `parts` selects what to
+    compute: 'skin' (the skin classifier) and/or 'lips' (the palette vote).
+    Each part is cached by the image content and the model version (see
+    result_cache), so a repeated image runs no model at all, and a part
+    requested later only runs what is missing. `image` may pass `src`
+    already decoded. If `mask_path` is given the skin mask is written there,
+    and the cache is not read so that the mask is always produced. When a
+    `timing` dict is given, the seconds spent in each stage are stored in it.
+    `key` may pass the `cache_key` of `src` when the caller already has it.
+
+    Returns a dict with `face_found`, `skin_probs` (the probabilities of
+    skin_model.predict_season as a list) and `lips` (the result of
+    summarize_lip_colors). A part is None when it was not requested or no
+    face is detected.
+    """
+    start = time.perf_counter()
+    result = {'face_found': None, 'skin_probs': None, 'lips': None}
+    missing = list(parts)
+    cache = result_cache.get_cache()
+    if cache is None:
+        key = None
+    elif key is None:
+        content = _content(src)
+        key = cache.key(content)
+        if not isinstance(src, np.ndarray):
+            src = content  # decode from the bytes already read
+    if key is not None and mask_path is None:
+        missing = []
+        for part in parts:
+            part_key = _part_key(key, part)
+            entry = None if part_key is None else cache.get(part_key)
+            if entry is None:
+                missing.append(part)
+                continue
+            result['face_found'] = entry['face_found']
+            result[COLOR_PARTS[part]] = entry['value']
+        # no face is the same answer for every part
+        if not missing or result['face_found'] is False:
+            if timing is not None:
+                timing['cache'] = time.perf_counter() - start
+            return result
+
+    stages = {}
+    start = time.perf_counter()
+    if image is None:
+        image = load_image(src)
+    stages['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    analysis = analyze_face(image)
+    stages['face_analysis'] = time.perf_counter() - start
+
+    result['face_found'] = analysis['face_found']
+    if analysis['face_found']:
+        if mask_path:
+            write_skin_mask(analysis, mask_path)
+
+        if 'skin' in missing:
+            start = time.perf_counter()
+            with telemetry.span('classify', get_registry().device):
+                probs = skin_model.predict_season(skin_masked_image(analysis))
+            result['skin_probs'] = [float(p) for p in probs]
+            stages['skin'] = time.perf_counter() - start
+
+        if 'lips' in missing:
+            start = time.perf_counter()
+            with telemetry.span('palette'):
+                result['lips'] = summarize_lip_colors(analysis['lip_rgb_codes'])
+            stages['lip'] = time.perf_counter() - start
+
+    if key is not None:
+        # without a face every part is known, so all of them are stored
+        for part in missing if analysis['face_found'] else COLOR_PARTS:
+            part_key = _part_key(key, part)
+            if part_key is not None:
+                cache.put(part_key, {'face_found': analysis['face_found'],
+                                     'value': result[COLOR_PARTS[part]]})
+    if timing is not None:
+        timing.update(stages)
+    return result
+
+
+def get_rgb_codes(path):
+    return analyze_face(path)['lip_rgb_codes']
+
+def filter_lip(rgb_codes):
     blue_condition = (rgb_codes[:, 2] <= 227)
     red_condition = (rgb_codes[:, 0] >= 97)
-    filtered_rgb_codes = rgb_codes[blue_condition & red_condition]
-    random_index = np.random.randint(0,filtered_rgb_codes.shape[0],randomNum)
+    return rgb_codes[blue_condition & red_condition]
+
+
+def filter_lip_random(rgb_codes,randomNum=40,seed=None):
+    filtered_rgb_codes = filter_lip(rgb_codes)
+    rng = np.random.default_rng(seed)
+    random_index = rng.integers(0,filtered_rgb_codes.shape[0],randomNum)
     random_rgb_codes = filtered_rgb_codes[random_index]
     return random_rgb_codes
 
 
-def calc_dis(rgb_codes):
-    spring = [[253,183,169],[247,98,77],[186,33,33]]
-    summer = [[243,184,202],[211,118,155],[147,70,105]]
-    autum = [[210,124,110],[155,70,60],[97,16,28]]
-    winter = [[237,223,227],[177,47,57],[98,14,37]]
-  
-    res = []
-    for i in range(len(rgb_codes)):
-      sp = np.inf
-      su = np.inf
-      au = np.inf
-      win = np.inf
-      for j in range(3):
-        sp = min(sp, np.linalg.norm(rgb_codes[i] - spring[j]))
-        su = min(su, np.linalg.norm(rgb_codes[i]- summer[j]))
-        au = min(au, np.linalg.norm(rgb_codes[i] - autum[j]))
-        win = min(win, np.linalg.norm(rgb_codes[i] - winter[j]))
-    
-      min_type = min(sp, su, au, win)
-      if min_type == sp:
-        ctype = "sp"
-      elif min_type == su:
-        ctype = "su"
-      elif min_type == au:
-        ctype = "au"
-      elif min_type == win:
-        ctype = "win"
-    
-      res.append(ctype)
-    return res
-
-
-def save_skin_mask(img_path):
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    image = facer.hwc2bchw(facer.read_hwc(img_path)).to(device=device)  # image: 1 x 3 x h x w
-    face_detector = facer.face_detector('retinaface/mobilenet', device=device)
+def summarize_lip_colors(rgb_codes, max_samples=None, seed=0, metric='rgb'):
+    """Deterministic season vote over every filtered lip pixel.
 
-    with torch.inference_mode():
-      faces = face_detector(image)
+    Identical colors are counted once and weighted by their pixel count, so
+    the palette distances are computed only for the distinct colors of the
+    mask. If `max_samples` is given and the mask is larger, a sample of that
+    size is drawn without replacement with a fixed `seed`.
 
-    image = facer.hwc2bchw(facer.read_hwc(img_path)).to(device=device)
-    face_parser = facer.face_parser('farl/lapa/448', device=device)
-    with torch.inference_mode():
-      faces = face_parser(image, faces)
+    Returns a dict with the winning season key (None if no pixel survives
+    the filter), the vote per season, the confidence (share of votes of
+    the winner) and the number of pixels used.
+    """
+    classifier = palette.get_classifier(metric)
+    filtered_rgb_codes = filter_lip(rgb_codes)
+    if max_samples is not None and filtered_rgb_codes.shape[0] > max_samples:
+        rng = np.random.default_rng(seed)
+        index = rng.choice(filtered_rgb_codes.shape[0], max_samples, replace=False)
+        filtered_rgb_codes = filtered_rgb_codes[np.sort(index)]
 
-    seg_logits = faces['seg']['logits']
-    seg_probs = seg_logits.softmax(dim=1)
-    seg_probs = seg_probs.cpu() #if you are using GPU
-    tensor = seg_probs.permute(0, 2, 3, 1)
-    tensor = tensor.squeeze().numpy()
+    # weighted histogram of the exact colors: pack r, g, b into one integer
+    codes = filtered_rgb_codes.astype(np.int64)
+    packed = (codes[:, 0] << 16) | (codes[:, 1] << 8) | codes[:, 2]
+    colors, counts = np.unique(packed, return_counts=True)
+    colors = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1)
 
-    face_skin = tensor[:, :, 1]
-    binary_mask = (face_skin >= 0.5).astype(int)
+    votes = np.bincount(classifier.classify(colors), weights=counts,
+                        minlength=len(classifier.keys))
+    total = int(counts.sum())
+    if total == 0:
+        winner, confidence = None, 0.0
+    else:
+        best = int(votes.argmax())  # ties favour the first season
+        winner, confidence = classifier.keys[best], float(votes[best] / total)
 
-    sample = cv2.imread(img_path)
-    img = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
-    masked_image = np.zeros_like(img) 
+    return {
+        'type': winner,
+        'votes': {key: int(v) for key, v in zip(classifier.keys, votes)},
+        'confidence': confidence,
+        'pixels': total,
+    }
+
+
+def calc_dis(rgb_codes, metric='rgb'):
+    # Nearest season palette for every pixel, computed as one
+    # pixels x swatches distance matrix (see palette.PaletteClassifier)
+    return palette.get_classifier(metric).labels(rgb_codes)
+
+
+def skin_masked_image(analysis):
+    """RGB image with every pixel outside the face-skin mask set to black"""
+    img = analysis['image']
+    binary_mask = analysis['skin_mask']
+    masked_image = np.zeros_like(img)
+    masked_image[binary_mask] = img[binary_mask]
+    return masked_image
+
+
+def write_skin_mask(analysis, out_path="temp.jpg"):
+    # Debug sink only: the classifier consumes skin_masked_image directly
     try: 
-      masked_image[binary_mask == 1] = img[binary_mask == 1] 
-      masked_image = cv2.cvtColor(masked_image,cv2.COLOR_BGR2RGB)
-      cv2.imwrite("temp.jpg" , masked_image)
+      masked_image = cv2.cvtColor(skin_masked_image(analysis),cv2.COLOR_RGB2BGR)
+      cv2.imwrite(out_path , masked_image)
     except:
-      print("error occurred")
\ No newline at end of file
+      print("error occurred")
+
+
+def save_skin_mask(img_path, out_path="temp.jpg"):
+    write_skin_mask(analyze_face(img_path), out_path)
@@ -0,0 +1,70 @@
+"""
+Pool acotado de workers para ejecutar la inferencia fuera del event loop
+
+Los handlers async de FastAPI envían aquí el trabajo de PyTorch. El pool
+admite como máximo `workers + max_queue` trabajos a la vez (en ejecución o
+en cola); por encima de ese límite rechaza con `PoolSaturated` para que la
+API responda 429 en lugar de acumular latencia.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class PoolSaturated(Exception):
+    """Se lanza cuando el pool no admite más trabajos"""
+
+
+class InferencePool:
+
+    def __init__(self, workers=2, max_queue=8):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='inference')
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        # Repartir los núcleos entre los workers para que las operaciones
+        # intra-op de cada inferencia no compitan entre sí
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        torch.set_num_threads(threads)
+
+    @property
+    def pending(self):
+        """Trabajos en ejecución o en cola"""
+        return self._pending
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """Ejecuta `fn(*args, **kwargs)` en el pool y espera su resultado"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturated(
+                f'{self.workers + self.max_queue} trabajos en curso')
+
+        with self._lock:
+            self._pending += 1
+        # El cupo se libera cuando termina el trabajo, no cuando el cliente
+        # deja de esperar, para que una desconexión no exceda el límite
+        future = self._executor.submit(functools.partial(fn, *args, **kwargs))
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def pool_from_env():
+    return InferencePool(
+        workers=int(os.environ.get('COLORINSIGHT_WORKERS', '2')),
+        max_queue=int(os.environ.get('COLORINSIGHT_MAX_QUEUE', '8')))
@@ -1,20 +1,69 @@
 import fastapi
 import functions as f
 import cv2
-from PIL import Image
-from collections import Counter
+from PIL import Image, UnidentifiedImageError
 import numpy as np
 import os
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi import FastAPI, File, UploadFile
 import base64
-import skin_model as m
+import binascii
+import json
 import requests
+import uuid
+import threading
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks
+from model_registry import get_registry
+from inference_pool import PoolSaturated, pool_from_env
+from result_cache import get_cache
+import telemetry
             
 
-app = FastAPI()
+# Pool acotado donde se ejecuta la inferencia, fuera del event loop
+pool = pool_from_env()
+
+
+# Error del calentamiento inicial, si lo hubo (ver /readyz)
+error_arranque = None
+
+
+def preparar_modelos():
+    """
+    Carga y calienta todos los modelos con una entrada sintética
+    """
+    global error_arranque
+    try:
+        get_registry().warmup()
+    except Exception as e:
+        import traceback
+        error_arranque = str(e)
+        print(f"Error warming up models: {e}\n{traceback.format_exc()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global error_arranque
+    # La caché (y el hash de los modelos que forma su clave) se crea antes
+    # de recibir tráfico, no en el primer /metrics o /models del event loop
+    try:
+        get_cache()
+    except Exception as e:
+        error_arranque = str(e)
+        print(f"Error creating result cache: {e}")
+    # El calentamiento corre en segundo plano: /healthz responde de
+    # inmediato y /readyz indica cuándo el worker puede recibir tráfico
+    threading.Thread(target=preparar_modelos, name='warmup', daemon=True).start()
+    yield
+    pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Directorio opcional donde guardar la máscara de piel para depuración
+DEBUG_DIR = os.environ.get("COLORINSIGHT_DEBUG_DIR")
 
 origins = [
     "http://localhost:3000"  # 스프링 부트 애플리케이션이 실행 중인 도메인
@@ -39,54 +88,297 @@ async def root():
         "endpoints": {
             "/image": "POST - Analiza tono de piel (Personal Color)",
             "/lip": "POST - Analiza color de labios",
+            "/analyze": "POST - Piel y labios en una sola solicitud",
+            "/models": "GET - Tiempos de carga y memoria de los modelos, aciertos de caché",
+            "/metrics": "GET - Latencia por etapa en formato Prometheus",
+            "/healthz": "GET - El proceso está vivo",
+            "/readyz": "GET - Modelos cargados y calentados (503 mientras tanto)",
             "/docs": "GET - Documentación interactiva"
         }
     }
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: el proceso responde, aunque los modelos aún se estén cargando
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: 200 solo cuando todos los modelos están cargados y calentados
+    """
+    registry = get_registry()
+    if error_arranque is not None:
+        return JSONResponse(status_code=503, content={"status": "error", "detail": error_arranque})
+    if not registry.is_ready():
+        return JSONResponse(status_code=503, content={"status": "warming"})
+    return {"status": "ready", "warmup_seconds": registry.warmup_seconds}
+
+
+@app.get("/models")
+async def models():
+    """
+    Métricas de los modelos cargados: tiempo de carga y memoria de pesos
+    """
+    registry = get_registry()
+    cache = get_cache()
+    return {
+        "device": str(registry.device),
+        "models": registry.metrics(),
+        "grid_cache": registry.cache_metrics(),
+        "result_cache": cache.stats() if cache is not None else None
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Histograma de latencia por etapa del pipeline y estado del pool y de la
+    caché, en formato de texto de Prometheus
+    """
+    lines = [
+        '# HELP colorinsight_pool_pending Inferencias en ejecución o en cola',
+        '# TYPE colorinsight_pool_pending gauge',
+        f'colorinsight_pool_pending {pool.pending}',
+    ]
+    cache = get_cache()
+    if cache is not None:
+        stats = cache.stats()
+        lines += [
+            '# HELP colorinsight_result_cache_total Consultas a la caché de resultados',
+            '# TYPE colorinsight_result_cache_total counter',
+            f'colorinsight_result_cache_total{{result="memory_hit"}} {stats["memory_hits"]}',
+            f'colorinsight_result_cache_total{{result="disk_hit"}} {stats["disk_hits"]}',
+            f'colorinsight_result_cache_total{{result="miss"}} {stats["misses"]}',
+        ]
+    return telemetry.timer.prometheus() + '\n'.join(lines) + '\n'
+
+
+def notificar_spring(url, payload):
+    """
+    Envía el resultado al servidor Spring Boot. Se ejecuta como tarea en
+    segundo plano después de responder al cliente.
+    """
+    try:
+        encoded_data = base64.b64encode(str(payload).encode('utf-8')).decode('utf-8')
+        requests.post(url, json={'encodedData':encoded_data}, timeout=1)
+    except:
+        # Si el servidor Spring Boot no está disponible, simplemente continuar
+        pass
+
+
+async def leer_imagen(request: Request):
+    """
+    Obtiene los bytes de la imagen según el Content-Type de la solicitud:
+
+    * application/json: {"image": "data:image/jpeg;base64,..."} (compatibilidad)
+    * multipart/form-data: archivo en el campo "image"
+    * application/octet-stream o image/*: bytes de la imagen en el cuerpo
+
+    Retorna (bytes de la imagen, data URL original o None)
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    if content_type == "multipart/form-data":
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Falta el archivo 'image'")
+        body = await upload.read()
+        if not body:
+            raise HTTPException(status_code=400, detail="Archivo 'image' vacío")
+        return body, None
+
+    if content_type == "application/octet-stream" or content_type.startswith("image/"):
+        body = await request.body()
+        if not body:
+            raise HTTPException(status_code=400, detail="Cuerpo vacío")
+        return body, None
+
+    # Errores del cliente: 400/422 como con el antiguo `data: dict`, no 500
+    try:
+        data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="JSON inválido")
+    try:
+        image_data = data["image"]
+        encoded = image_data.split(",")[1]
+    except (KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=422, detail="Falta el campo 'image' (data URL)")
+    except IndexError:
+        raise HTTPException(status_code=422, detail="El campo 'image' no es una data URL")
+    try:
+        return base64.b64decode(encoded), image_data
+    except binascii.Error:
+        raise HTTPException(status_code=400, detail="Base64 inválido en 'image'")
+
+
+def como_data_url(decoded_image):
+    return "data:image/jpeg;base64," + base64.b64encode(decoded_image).decode('utf-8')
+
+
+def notificar_labios(url, image_data, decoded_image, result):
+    # Las subidas binarias no traen data URL; se genera aquí, fuera del event loop
+    if image_data is None:
+        image_data = como_data_url(decoded_image)
+    notificar_spring(url, {'image': image_data, 'result': result})
+
+
+async def ejecutar_en_pool(fn, *args):
+    """
+    Ejecuta la inferencia en el pool; responde 429 si está saturado
+    """
+    try:
+        return await pool.run(fn, *args)
+    except PoolSaturated:
+        raise HTTPException(status_code=429, detail="Servidor ocupado, intente más tarde",
+                            headers={"Retry-After": "1"})
+    except UnidentifiedImageError:
+        # Los bytes recibidos no son una imagen: error del cliente
+        raise HTTPException(status_code=400, detail="No se pudo decodificar la imagen")
+
+
+def codigo_temporada(index):
+    """
+    Índice de clase del modelo de piel -> código 1=Spring ... 4=Winter
+    """
+    if index == 3:
+        return 4
+    elif index == 0:
+        return 3
+    return index
+
+
+# Respuesta para imágenes sin rostro: no es un error del servidor
+SIN_ROSTRO = {'result': 0, 'season': "Unknown", 'message': 'no face detected'}
+
+
+def colores(decoded_image, parts=('skin', 'lips'), timing=None):
+    """
+    Probabilidades de piel y/o resumen de labios, desde la caché si la
+    imagen ya se analizó (ver functions.analyze_colors)
+    """
+    mask_path = None
+    if DEBUG_DIR:
+        mask_path = os.path.join(DEBUG_DIR, f"skin_mask_{uuid.uuid4().hex}.jpg")
+    return f.analyze_colors(decoded_image, parts=parts, mask_path=mask_path,
+                            timing=timing)
+
+
+def resultado_piel(probs):
+    """
+    Clasifica la temporada a partir de las probabilidades del modelo de piel
+    """
+    ans = codigo_temporada(int(np.argmax(probs)))
+    print("Decided color: ", ans)
+
+    # Mapear el resultado a nombres de temporadas
+    season_names = {1: "Spring", 2: "Summer", 3: "Autumn", 4: "Winter"}
+
+    return {
+        'result': ans,
+        'season': season_names.get(ans, "Unknown"),
+        'probabilities': {season_names[codigo_temporada(i)]: round(float(p), 4)
+                          for i, p in enumerate(probs)},
+        'message': 'complete'
+    }
+
+
+def resultado_labios(summary):
+    """
+    Determina la paleta de labios a partir del resumen de colores del labio
+    """
+    # Votación determinista sobre todos los píxeles del labio
+    max_value_key = summary['type']
+    print(f"Lip color analysis result: {max_value_key}")
+    
+    if max_value_key == 'sp':
+        result = 1
+    elif max_value_key == 'su':
+        result = 2
+    elif max_value_key == 'au':
+        result = 3
+    elif max_value_key == 'win':
+        result = 4
+    else:
+        result = 0
+    
+    # Mapear el resultado a nombres de temporadas
+    season_names = {1: "Spring", 2: "Summer", 3: "Autumn", 4: "Winter"}
+    
+    return {
+        'result': result,
+        'season': season_names.get(result, "Unknown"),
+        'analysis_type': max_value_key,
+        'confidence': round(summary['confidence'], 4),
+        'message': 'complete'
+    }
+
+
+def analizar_piel(decoded_image):
+    """
+    Inferencia de tono de piel (bloqueante, se ejecuta en el pool)
+    """
+    # Todo el procesamiento ocurre en memoria, sin archivos temporales
+    resultado = colores(decoded_image, parts=('skin',))
+    if not resultado['face_found']:
+        return None
+    return resultado_piel(resultado['skin_probs'])
+
+
+def analizar_labios(decoded_image):
+    """
+    Inferencia de color de labios (bloqueante, se ejecuta en el pool)
+    """
+    resultado = colores(decoded_image, parts=('lips',))
+    if not resultado['face_found']:
+        return None
+    return resultado_labios(resultado['lips'])
+
+
+def analizar_completo(decoded_image):
+    """
+    Piel y labios con una sola decodificación, detección y parsing
+    (bloqueante, se ejecuta en el pool)
+    """
+    timing = {}
+    resultado = colores(decoded_image, timing=timing)
+    if not resultado['face_found']:
+        return None
+
+    timing['total'] = sum(timing.values())
+    return {
+        'skin': resultado_piel(resultado['skin_probs']),
+        'lip': resultado_labios(resultado['lips']),
+        'timing_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timing.items()},
+        'message': 'complete'
+    }
+
+
 @app.post("/image")
-async def image(data: dict):
+async def image(request: Request, background_tasks: BackgroundTasks):
     """
     Analiza el tono de piel y determina el tipo de color personal
+    Acepta JSON con base64, multipart/form-data o application/octet-stream
     Retorna: 1=Spring, 2=Summer, 3=Autumn, 4=Winter
     """
     try:
-        image_data = data["image"]
-        decoded_image = base64.b64decode(image_data.split(",")[1])
-
-        with open("saved.jpg","wb") as fi:
-            fi.write(decoded_image)
-      
-        f.save_skin_mask("saved.jpg")
-   
-        ans = m.get_season("temp.jpg")
-        os.remove("temp.jpg")
-        os.remove("saved.jpg")
-   
-        if ans == 3:
-            ans += 1
-        elif ans == 0:
-            ans = 3
-
-        # Mapear el resultado a nombres de temporadas
-        season_names = {1: "Spring", 2: "Summer", 3: "Autumn", 4: "Winter"}
-        
-        result_data = {
-            'result': ans,
-            'season': season_names.get(ans, "Unknown"),
-            'message': 'complete'
-        }
+        decoded_image, _ = await leer_imagen(request)
+
+        result_data = await ejecutar_en_pool(analizar_piel, decoded_image)
+        if result_data is None:
+            return JSONResponse(status_code=422, content=SIN_ROSTRO)
         
-        # Intentar enviar al servidor Spring Boot si está disponible
-        try:
-            test = {'result': ans}
-            encoded_data = base64.b64encode(str(test).encode('utf-8')).decode('utf-8')
-            requests.post('http://localhost:3000/output', json={'encodedData':encoded_data}, timeout=1)
-        except:
-            # Si el servidor Spring Boot no está disponible, simplemente continuar
-            pass
+        # Intentar enviar al servidor Spring Boot sin bloquear la respuesta
+        background_tasks.add_task(notificar_spring, 'http://localhost:3000/output',
+                                  {'result': result_data['result']})
         
         return JSONResponse(content=result_data)
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         error_detail = f"Error processing image: {str(e)}\n{traceback.format_exc()}"
@@ -95,65 +387,58 @@ async def image(data: dict):
 
 
 @app.post("/lip")
-async def lip(data: dict):
+async def lip(request: Request, background_tasks: BackgroundTasks):
     """
     Analiza el color de labios y determina el tipo de paleta
+    Acepta JSON con base64, multipart/form-data o application/octet-stream
     Retorna: 1=Spring, 2=Summer, 3=Autumn, 4=Winter
     """
     try:
-        image_data = data["image"]
-        decoded_image = base64.b64decode(image_data.split(",")[1])
-       
-        with open("saved.jpg","wb") as fi:
-            fi.write(decoded_image)
-        
-        path = r"saved.jpg"
+        decoded_image, image_data = await leer_imagen(request)
        
-        rgb_codes = f.get_rgb_codes(path)  #check point
-     
-        random_rgb_codes = f.filter_lip_random(rgb_codes,40) #set number of randomly picked sample as 40
-
-        os.remove("saved.jpg")
-     
-        types = Counter(f.calc_dis(random_rgb_codes))
-    
-        max_value_key = max(types, key=types.get)
-        print(f"Lip color analysis result: {max_value_key}")
-        
-        if max_value_key == 'sp':
-            result = 1
-        elif max_value_key == 'su':
-            result = 2
-        elif max_value_key == 'au':
-            result = 3
-        elif max_value_key == 'win':
-            result = 4
-        else:
-            result = 0
+        result_data = await ejecutar_en_pool(analizar_labios, decoded_image)
+        if result_data is None:
+            return JSONResponse(status_code=422, content=SIN_ROSTRO)
         
-        # Mapear el resultado a nombres de temporadas
-        season_names = {1: "Spring", 2: "Summer", 3: "Autumn", 4: "Winter"}
-        
-        result_data = {
-            'result': result,
-            'season': season_names.get(result, "Unknown"),
-            'analysis_type': max_value_key,
-            'message': 'complete'
-        }
-        
-        # Intentar enviar al servidor Spring Boot si está disponible
-        try:
-            data_to_send = {'image': image_data, 'result': result}
-            encoded_data = base64.b64encode(str(data_to_send).encode('utf-8')).decode('utf-8')        
-            requests.post("http://localhost:3000/output2", json={'encodedData':encoded_data}, timeout=1)
-        except:
-            # Si el servidor Spring Boot no está disponible, simplemente continuar
-            pass
+        # Intentar enviar al servidor Spring Boot sin bloquear la respuesta
+        background_tasks.add_task(notificar_labios, "http://localhost:3000/output2",
+                                  image_data, decoded_image, result_data['result'])
         
         return JSONResponse(content=result_data)
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         error_detail = f"Error processing lip image: {str(e)}\n{traceback.format_exc()}"
         print(error_detail)
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.post("/analyze")
+async def analyze(request: Request, background_tasks: BackgroundTasks):
+    """
+    Analiza tono de piel y color de labios con una sola imagen
+    Acepta JSON con base64, multipart/form-data o application/octet-stream
+    Retorna ambos resultados y el tiempo de cada etapa en milisegundos
+    """
+    try:
+        decoded_image, image_data = await leer_imagen(request)
+
+        result_data = await ejecutar_en_pool(analizar_completo, decoded_image)
+        if result_data is None:
+            return JSONResponse(status_code=422, content=SIN_ROSTRO)
+
+        # Mismas notificaciones que /image y /lip, sin bloquear la respuesta
+        background_tasks.add_task(notificar_spring, 'http://localhost:3000/output',
+                                  {'result': result_data['skin']['result']})
+        background_tasks.add_task(notificar_labios, "http://localhost:3000/output2",
+                                  image_data, decoded_image, result_data['lip']['result'])
+
+        return JSONResponse(content=result_data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        error_detail = f"Error processing analysis: {str(e)}\n{traceback.format_exc()}"
+        print(error_detail)
+        raise HTTPException(status_code=500, detail=str(e))
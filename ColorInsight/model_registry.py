@@ -0,0 +1,251 @@
+"""
+Registro de modelos de ColorInsight
+
+Carga una sola vez por proceso el detector RetinaFace, el parser FaRL y el
+clasificador ResNet-18 de temporadas, y los comparte entre la API
+(main.py), la CLI (colorInsight.py) y el procesamiento por lotes.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import torch
+
+import facer
+import facer.transform
+
+
+DETECTOR_NAME = 'retinaface/mobilenet'
+PARSER_NAME = 'farl/lapa/448'
+PARSER_MASKS = {'skin': ['face'], 'lips': ['ulip', 'llip']}
+
+
+# Se incrementa cuando cambia el formato de los resultados en caché
+RESULT_VERSION = 2
+
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def model_version():
+    """
+    Identificador de los modelos y ajustes que determinan un resultado
+
+    Incluye el hash de las paletas y los ajustes de resolución de
+    decodificación y detección. Los pesos del clasificador solo afectan a
+    la piel y van aparte (ver `classifier_version`). Se calcula una sola
+    vez por proceso.
+    """
+    with _versions_lock:
+        if 'models' not in _versions:
+            import palette
+            from facer.model_store import sha256_file
+
+            parts = [
+                str(RESULT_VERSION), DETECTOR_NAME, PARSER_NAME,
+                json.dumps(PARSER_MASKS, sort_keys=True),
+                sha256_file(palette.DEFAULT_PALETTES),
+                os.environ.get('COLORINSIGHT_DECODE_SIZE', '0'),
+                os.environ.get('COLORINSIGHT_DETECT_SIZE', '640'),
+            ]
+            _versions['models'] = hashlib.sha256(
+                '|'.join(parts).encode('utf-8')).hexdigest()[:16]
+        return _versions['models']
+
+
+def classifier_version():
+    """
+    Hash de los pesos del clasificador de piel, o None si no se pueden leer
+
+    Se calcula (o se falla) una sola vez por proceso; sin pesos los
+    resultados de piel no se guardan en la caché, pero el resto sí.
+    """
+    with _versions_lock:
+        if 'classifier' not in _versions:
+            import skin_model
+            from facer.model_store import sha256_file
+
+            try:
+                _versions['classifier'] = sha256_file(skin_model.MODEL_PATH)[:16]
+            except OSError:
+                _versions['classifier'] = None
+        return _versions['classifier']
+
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def _module_nbytes(module):
+    """Bytes ocupados por parámetros y buffers de un módulo"""
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelRegistry:
+    """
+    Contenedor perezoso y thread-safe de los modelos del pipeline.
+
+    Cada modelo se construye la primera vez que se pide (o en `warmup`) y
+    se reutiliza en las llamadas siguientes. Para cada carga se registra el
+    tiempo empleado y la memoria de sus pesos.
+    """
+
+    def __init__(self, device=None):
+        self.device = device or default_device()
+        # Reutilizar grids de alineación entre cuadros idénticos (kiosco)
+        facer.transform.set_grid_cache(
+            int(os.environ.get('COLORINSIGHT_GRID_CACHE', '0')))
+        self._models = {}
+        self._metrics = {}
+        self._warmup_seconds = None
+        self._lock = threading.Lock()
+        self._loaders = {
+            'detector': self._load_detector,
+            'parser': self._load_parser,
+            'classifier': self._load_classifier,
+        }
+
+    def _load_detector(self):
+        # ColorInsight solo analiza el rostro más grande, y detectarlo no
+        # requiere la resolución completa de la foto
+        target_size = int(os.environ.get('COLORINSIGHT_DETECT_SIZE', '640'))
+        return facer.face_detector(
+            DETECTOR_NAME, device=self.device,
+            target_size=target_size or None, max_faces=1, largest_face=True)
+
+    def _load_parser(self):
+        # Solo alrededor del rostro (memoria proporcional a la cara) y como
+        # máscaras booleanas de las clases que usa el pipeline
+        return facer.face_parser(
+            PARSER_NAME, device=self.device, crop_to_face=True,
+            output='labels', masks=PARSER_MASKS)
+
+    def _load_classifier(self):
+        import skin_model
+        return skin_model.load_model(device=self.device)
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            # Otro hilo pudo haberlo cargado mientras esperábamos el lock
+            model = self._models.get(name)
+            if model is not None:
+                return model
+
+            if name not in self._loaders:
+                raise KeyError(f'Modelo desconocido: {name}')
+
+            start = time.perf_counter()
+            model = self._loaders[name]()
+            load_seconds = time.perf_counter() - start
+
+            self._metrics[name] = {
+                'load_seconds': round(load_seconds, 4),
+                'memory_bytes': _module_nbytes(model),
+                'device': str(self.device),
+            }
+            self._models[name] = model
+            print(f"📦 Modelo '{name}' cargado en {load_seconds:.2f}s")
+            return model
+
+    def detector(self):
+        return self.get('detector')
+
+    def parser(self):
+        return self.get('parser')
+
+    def classifier(self):
+        return self.get('classifier')
+
+    def warmup(self, run=True, size=None, passes=2):
+        """
+        Carga todos los modelos registrados
+
+        Con `run`, además ejecuta `passes` pasadas de cada modelo con una
+        entrada sintética de `size` x `size` (por defecto
+        COLORINSIGHT_WARMUP_SIZE), para que la primera solicitud real no pague
+        la optimización de TorchScript ni la inicialización de los kernels.
+        """
+        for name in self._loaders:
+            self.get(name)
+        if not run or self._warmup_seconds is not None:
+            return
+
+        start = time.perf_counter()
+        self._warm_pipeline(
+            size or int(os.environ.get('COLORINSIGHT_WARMUP_SIZE', '1024')), passes)
+        self._warmup_seconds = round(time.perf_counter() - start, 4)
+        print(f"🔥 Modelos calentados en {self._warmup_seconds:.2f}s")
+
+    def _warm_pipeline(self, size, passes):
+        import skin_model
+
+        generator = torch.Generator().manual_seed(0)
+        image = torch.randint(0, 256, (1, 3, size, size), dtype=torch.uint8,
+                              generator=generator).to(self.device)
+
+        # El ruido no tiene rostros: el parser recibe una detección
+        # sintética centrada, con los 5 puntos de referencia de RetinaFace
+        c, s = size / 2, size / 4
+        faces = {
+            'rects': torch.tensor([[c - s / 2, c - s / 2, c + s / 2, c + s / 2]]),
+            'points': torch.tensor([[
+                [c - 0.2 * s, c - 0.1 * s], [c + 0.2 * s, c - 0.1 * s],
+                [c, c + 0.05 * s],
+                [c - 0.15 * s, c + 0.25 * s], [c + 0.15 * s, c + 0.25 * s]]]),
+            'scores': torch.ones(1),
+            'image_ids': torch.zeros(1, dtype=torch.int64),
+        }
+        faces = {key: value.to(self.device) for key, value in faces.items()}
+        skin = torch.zeros(len(skin_model.TTA_FLIP_DIMS), 3, 224, 224, device=self.device)
+
+        with torch.inference_mode():
+            for _ in range(passes):
+                self.detector()(image)
+                self.parser()(image, dict(faces))
+                self.classifier()(skin)
+        if str(self.device).startswith('cuda'):
+            torch.cuda.synchronize(self.device)
+
+    def is_loaded(self, name=None):
+        if name is None:
+            return all(n in self._models for n in self._loaders)
+        return name in self._models
+
+    def is_ready(self):
+        """Todos los modelos cargados y calentados"""
+        return self.is_loaded() and self._warmup_seconds is not None
+
+    @property
+    def warmup_seconds(self):
+        return self._warmup_seconds
+
+    def metrics(self):
+        return {name: dict(values) for name, values in self._metrics.items()}
+
+    def cache_metrics(self):
+        return facer.transform.grid_cache_info()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Devuelve el registro compartido del proceso"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry(os.environ.get('COLORINSIGHT_DEVICE'))
+    return _registry
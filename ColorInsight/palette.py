@@ -0,0 +1,99 @@
+"""
+Clasificación vectorizada de colores de labios por paleta de temporada
+
+Las paletas se leen de data/palettes.json. Para N píxeles y S muestras de
+color se calcula una matriz de distancias N x S en una sola operación y
+cada píxel se asigna a la temporada de la muestra más cercana.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+DEFAULT_PALETTES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'palettes.json')
+
+METRICS = ('rgb', 'de2000')
+
+
+def load_palettes(path=None):
+    """Lee las temporadas (key, name, swatches) en el orden del archivo"""
+    with open(path or DEFAULT_PALETTES, encoding='utf-8') as fp:
+        return json.load(fp)['seasons']
+
+
+def rgb_to_lab(rgb_codes):
+    """RGB 0-255 (... x 3) a CIE Lab con iluminante D65"""
+    import colour
+    rgb = np.asarray(rgb_codes, dtype=np.float64) / 255.0
+    return colour.XYZ_to_Lab(colour.sRGB_to_XYZ(rgb))
+
+
+class PaletteClassifier:
+    """
+    Args:
+        seasons: Lista de temporadas como la devuelve `load_palettes`.
+        metric: 'rgb' para distancia euclídea en RGB (comportamiento
+            original) o 'de2000' para ΔE2000 en el espacio Lab.
+    """
+
+    def __init__(self, seasons=None, metric='rgb'):
+        if metric not in METRICS:
+            raise ValueError(f'Métrica desconocida: {metric}')
+        if seasons is None:
+            seasons = load_palettes()
+
+        self.metric = metric
+        self.keys = [season['key'] for season in seasons]
+        self.names = [season['name'] for season in seasons]
+
+        swatches = []
+        offsets = []
+        for season in seasons:
+            offsets.append(len(swatches))
+            swatches.extend(season['swatches'])
+        self.swatches = np.asarray(swatches, dtype=np.float64)  # S x 3
+        # inicio de las muestras de cada temporada, para np.minimum.reduceat
+        self._offsets = np.asarray(offsets)
+        if metric == 'de2000':
+            self._swatches_lab = rgb_to_lab(self.swatches)
+
+    def swatch_distances(self, rgb_codes):
+        """Matriz N x S de distancias de cada píxel a cada muestra"""
+        pixels = np.asarray(rgb_codes, dtype=np.float64).reshape(-1, 3)
+        if self.metric == 'rgb':
+            diff = pixels[:, None, :] - self.swatches[None, :, :]
+            return np.sqrt(np.einsum('nsc,nsc->ns', diff, diff))
+
+        import colour
+        return colour.delta_E(
+            rgb_to_lab(pixels)[:, None, :], self._swatches_lab[None, :, :],
+            method='CIE 2000')
+
+    def season_distances(self, rgb_codes):
+        """Matriz N x T con la distancia a la muestra más cercana de cada temporada"""
+        distances = self.swatch_distances(rgb_codes)
+        if distances.shape[0] == 0:
+            return np.zeros((0, len(self.keys)))
+        return np.minimum.reduceat(distances, self._offsets, axis=1)
+
+    def classify(self, rgb_codes):
+        """Índice de temporada por píxel; los empates favorecen la primera"""
+        return self.season_distances(rgb_codes).argmin(axis=1)
+
+    def labels(self, rgb_codes):
+        """Clave de temporada ('sp', 'su', ...) por píxel"""
+        return [self.keys[i] for i in self.classify(rgb_codes)]
+
+
+_classifiers = {}
+
+
+def get_classifier(metric='rgb'):
+    """Clasificador compartido por métrica, con las paletas por defecto"""
+    classifier = _classifiers.get(metric)
+    if classifier is None:
+        classifier = _classifiers[metric] = PaletteClassifier(metric=metric)
+    return classifier
@@ -2,112 +2,384 @@
 # -*- coding: utf-8 -*-
 """
 Procesar múltiples imágenes con ColorInsight
+
+Las imágenes se descubren a medida que se recorre el directorio y se
+reparten entre un pool de procesos; cada worker carga los modelos una sola
+vez y decodifica por adelantado las imágenes siguientes. Cada resultado se
+agrega a un archivo JSONL en cuanto termina, de modo que una ejecución
+interrumpida puede reanudarse saltando las imágenes ya procesadas.
 """
 
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
 import os
 import sys
-import json
+import time
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
 from pathlib import Path
 
 # Importar el módulo principal
 import colorInsight
+import functions as f
+
+
+EXTENSIONES_VALIDAS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
+
+# Imágenes por tarea enviada a un worker. La primera lectura de cada trozo
+# no se solapa con inferencia, así que trozos grandes la amortizan; a cambio,
+# si un worker muere se pierden (y se repiten al reanudar) más imágenes
+TAMANO_TROZO = 16
+
+# Hilos de lectura y decodificación de cada worker, creados una sola vez
+_prefetch = None
+
+
+class PoolRoto(Exception):
+    """Se lanza cuando un worker del pool muere (falta de memoria, crash)"""
+
+    def __init__(self, restantes):
+        super().__init__(f"Un worker terminó inesperadamente; quedan "
+                         f"{restantes} imágenes sin procesar")
+        self.restantes = restantes
+
+
+def buscar_imagenes(directorio, recursivo=False):
+    """
+    Genera las imágenes del directorio a medida que se recorre
+
+    Un solo recorrido con os.scandir; la extensión se compara sin distinguir
+    mayúsculas, así cada archivo aparece una sola vez.
+    """
+    pendientes = [directorio]
+    while pendientes:
+        with os.scandir(pendientes.pop()) as entradas:
+            for entrada in entradas:
+                if entrada.is_dir(follow_symlinks=False):
+                    if recursivo:
+                        pendientes.append(entrada.path)
+                elif os.path.splitext(entrada.name)[1].lower() in EXTENSIONES_VALIDAS:
+                    yield Path(entrada.path)
+
+
+def _leer(ruta):
+    """
+    Bytes del archivo, su clave en la caché y la imagen decodificada si no
+    está en la caché
+
+    La clave se calcula una sola vez y se pasa al análisis.
+    """
+    datos = Path(ruta).read_bytes()
+    clave = f.cache_key(datos)
+    if f.is_cached(clave):
+        return datos, clave, None
+    return datos, clave, f.load_image(datos)
+
+
+def decodificar_con_prefetch(rutas, profundidad=4, hilos=2, executor=None):
+    """
+    Genera (ruta, (datos, clave, imagen), error) leyendo y decodificando por
+    adelantado en hilos
+
+    Como máximo `profundidad` imágenes decodificadas esperan en memoria, de
+    modo que la inferencia no espera al disco sin cargar todo el lote. Con
+    un `executor` se usan sus hilos (y no se cierra al terminar).
+    """
+    if executor is None:
+        contexto = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='decode')
+    else:
+        contexto = contextlib.nullcontext(executor)
+    with contexto as executor:
+        ventana = deque()
+        for ruta in rutas:
+            ventana.append((ruta, executor.submit(_leer, ruta)))
+            if len(ventana) > profundidad:
+                yield _decodificada(*ventana.popleft())
+        while ventana:
+            yield _decodificada(*ventana.popleft())
+
+
+def _decodificada(ruta, futuro):
+    try:
+        return ruta, futuro.result(), None
+    except Exception as e:
+        return ruta, None, e
 
 
-def procesar_directorio(ruta_directorio, output_file="resultados.json"):
+def analizar_rutas(rutas, executor=None):
+    """Genera (ruta, resultado) sin la salida detallada por consola"""
+    for ruta, leida, error in decodificar_con_prefetch(rutas, executor=executor):
+        if error is not None:
+            mensaje = f"Error al decodificar la imagen: {error}"
+            resultado = {"tono_piel": {"error": mensaje},
+                         "color_labios": {"error": mensaje}}
+        else:
+            datos, clave, imagen = leida
+            with contextlib.redirect_stdout(io.StringIO()):
+                resultado = colorInsight.analizar_completo(
+                    str(ruta), imagen=imagen, datos=datos, clave=clave)
+        yield ruta, resultado
+
+
+def workers_por_defecto():
+    import torch
+    if torch.cuda.is_available():
+        # Un solo proceso comparte mejor la GPU que varias copias del modelo
+        return 1
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def _iniciar_worker(workers):
+    """
+    Inicializador de cada proceso: reparte los núcleos, carga los modelos y
+    crea los hilos de lectura que usan todos sus trozos
+    """
+    import torch
+    from model_registry import get_registry
+
+    global _prefetch
+    _prefetch = ThreadPoolExecutor(max_workers=2, thread_name_prefix='decode')
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    with contextlib.redirect_stdout(io.StringIO()):
+        get_registry().warmup()
+
+
+def _procesar_trozo(rutas):
+    """Tarea de un worker: analiza unas pocas imágenes seguidas"""
+    return list(analizar_rutas(rutas, executor=_prefetch))
+
+
+def leer_procesadas(output_path):
+    """
+    Resultados ya escritos en un JSONL previo, por nombre de archivo.
+
+    Una línea que no es JSON válido se ignora y esa imagen se vuelve a
+    procesar.
+    """
+    resultados = {}
+    if not output_path.exists():
+        return resultados
+    with open(output_path, encoding='utf-8') as fp:
+        for linea in fp:
+            try:
+                registro = json.loads(linea)
+            except json.JSONDecodeError:
+                continue
+            resultados[registro['archivo']] = registro['resultado']
+    return resultados
+
+
+def descartar_linea_incompleta(output_path):
+    """
+    Recorta el JSONL hasta el último salto de línea
+
+    Tras un corte a mitad de escritura, la última línea queda sin terminar;
+    si no se recortara, el siguiente registro se agregaría a esa misma línea
+    y también se perdería.
+    """
+    if not output_path.exists():
+        return
+    with open(output_path, 'rb+') as fp:
+        fin = fp.seek(0, os.SEEK_END)
+        posicion = fin
+        while posicion > 0:
+            inicio = max(0, posicion - 4096)
+            fp.seek(inicio)
+            bloque = fp.read(posicion - inicio)
+            salto = bloque.rfind(b'\n')
+            if salto >= 0:
+                posicion = inicio + salto + 1
+                break
+            posicion = inicio
+        if posicion != fin:
+            fp.truncate(posicion)
+
+
+def procesar_directorio(ruta_directorio, output_file="resultados.jsonl",
+                        workers=None, reanudar=True, recursivo=False):
     """
     Procesa todas las imágenes en un directorio
-    
+
     Args:
         ruta_directorio: Ruta al directorio con imágenes
-        output_file: Archivo donde guardar los resultados
+        output_file: Archivo JSONL (dentro del directorio) donde se agrega
+            una línea `{"archivo": ..., "resultado": ...}` por imagen
+        workers: Procesos en paralelo (por defecto 1 con GPU, o la mitad
+            de los núcleos hasta 4 en CPU)
+        reanudar: Saltar las imágenes que ya tienen resultado en output_file
+        recursivo: Incluir las imágenes de los subdirectorios
     """
-    extensiones_validas = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
-    
     directorio = Path(ruta_directorio)
-    
-    if not directorio.exists():
+
+    if not directorio.is_dir():
         print(f"❌ El directorio no existe: {ruta_directorio}")
         return
-    
-    # Encontrar todas las imágenes
-    imagenes = []
-    for ext in extensiones_validas:
-        imagenes.extend(directorio.glob(f"*{ext}"))
-        imagenes.extend(directorio.glob(f"*{ext.upper()}"))
-    
-    if not imagenes:
+
+    output_path = directorio / output_file
+    if not reanudar and output_path.exists():
+        output_path.unlink()
+    descartar_linea_incompleta(output_path)
+    resultados = leer_procesadas(output_path)
+    if resultados:
+        print(f"⏭️  {len(resultados)} imágenes ya procesadas en {output_path.name}")
+
+    def nombre(imagen):
+        return imagen.relative_to(directorio).as_posix()
+
+    # El recorrido y el procesamiento avanzan juntos
+    pendientes = (imagen for imagen in buscar_imagenes(directorio, recursivo)
+                  if nombre(imagen) not in resultados)
+
+    workers = workers or workers_por_defecto()
+    print(f"\n🚀 Procesando imágenes con {workers} worker(s)...\n")
+    inicio = time.perf_counter()
+    hechas = 0
+
+    with open(output_path, 'a', encoding='utf-8') as salida:
+        if workers == 1:
+            analizadas = analizar_rutas(pendientes)
+        else:
+            analizadas = _analizar_en_pool(pendientes, workers)
+
+        for imagen, resultado in analizadas:
+            salida.write(json.dumps({"archivo": nombre(imagen), "resultado": resultado},
+                                    ensure_ascii=False) + "\n")
+            salida.flush()
+            resultados[nombre(imagen)] = resultado
+
+            hechas += 1
+            velocidad = hechas / (time.perf_counter() - inicio)
+            print(f"[{hechas}] {nombre(imagen)} ({velocidad:.2f} img/s)")
+
+    if not resultados:
         print(f"❌ No se encontraron imágenes en: {ruta_directorio}")
         return
-    
-    print(f"\n📁 Encontradas {len(imagenes)} imágenes")
-    print("🚀 Iniciando procesamiento por lotes...\n")
-    
-    resultados = {}
-    
-    for i, imagen in enumerate(imagenes, 1):
-        print(f"\n{'='*60}")
-        print(f"Procesando {i}/{len(imagenes)}: {imagen.name}")
-        print('='*60)
-        
-        try:
-            resultado = colorInsight.analizar_completo(str(imagen))
-            resultados[imagen.name] = resultado
-        except Exception as e:
-            print(f"❌ Error procesando {imagen.name}: {e}")
-            resultados[imagen.name] = {"error": str(e)}
-    
-    # Guardar resultados
-    output_path = directorio / output_file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(resultados, f, indent=2, ensure_ascii=False)
-    
+
     print(f"\n✅ Resultados guardados en: {output_path}")
-    
-    # Resumen
+    imprimir_resumen(resultados)
+
+
+def _analizar_en_pool(imagenes, workers):
+    """Genera (ruta, resultado) repartiendo trozos de imágenes entre procesos"""
+    # spawn: cada worker inicializa PyTorch desde cero (fork no es seguro
+    # con hilos de PyTorch ni con CUDA)
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_iniciar_worker, initargs=(workers,))
+
+    with executor:
+        en_curso = {}
+        sin_enviar = []
+
+        def enviar():
+            # Ventana acotada de trozos: el recorrido no se adelanta al pool
+            while len(en_curso) < 2 * workers:
+                trozo = list(islice(imagenes, TAMANO_TROZO))
+                if not trozo:
+                    break
+                try:
+                    futuro = executor.submit(_procesar_trozo, trozo)
+                except BrokenProcessPool:
+                    sin_enviar.extend(trozo)
+                    raise
+                en_curso[futuro] = trozo
+
+        try:
+            enviar()
+            while en_curso:
+                listos, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+                for futuro in listos:
+                    try:
+                        resultados = futuro.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        # Fallo del worker (no de la imagen): no se registra, así
+                        # el trozo se reintenta al reanudar
+                        trozo = en_curso.pop(futuro)
+                        print(f"❌ Error procesando {', '.join(p.name for p in trozo)}: {e}")
+                        continue
+                    del en_curso[futuro]
+                    yield from resultados
+                enviar()
+        except BrokenProcessPool:
+            # El pool ya no acepta trabajo: lo escrito hasta aquí queda en el
+            # JSONL y el resto se procesa al reanudar
+            restantes = len(sin_enviar) + sum(len(trozo) for trozo in en_curso.values())
+            restantes += sum(1 for _ in imagenes)
+            raise PoolRoto(restantes) from None
+
+
+def imprimir_resumen(resultados):
     print("\n" + "="*60)
     print("📊 RESUMEN DEL PROCESAMIENTO")
     print("="*60)
-    
+
     exitosos = sum(1 for r in resultados.values() if "error" not in r.get("tono_piel", {}))
-    print(f"Total de imágenes: {len(imagenes)}")
+    print(f"Total de imágenes: {len(resultados)}")
     print(f"Procesadas exitosamente: {exitosos}")
-    print(f"Con errores: {len(imagenes) - exitosos}")
-    
+    print(f"Con errores: {len(resultados) - exitosos}")
+
     # Distribución de temporadas
     temporadas_piel = {}
     temporadas_labios = {}
-    
+
     for nombre, resultado in resultados.items():
         if "error" not in resultado.get("tono_piel", {}):
             temporada = resultado["tono_piel"].get("temporada", "Desconocido")
             temporadas_piel[temporada] = temporadas_piel.get(temporada, 0) + 1
-        
+
         if "error" not in resultado.get("color_labios", {}):
             temporada = resultado["color_labios"].get("temporada", "Desconocido")
             temporadas_labios[temporada] = temporadas_labios.get(temporada, 0) + 1
-    
+
     if temporadas_piel:
         print("\n🎨 Distribución de Tonos de Piel:")
         for temporada, count in sorted(temporadas_piel.items(), key=lambda x: x[1], reverse=True):
             print(f"   {temporada}: {count} ({count/exitosos*100:.1f}%)")
-    
+
     if temporadas_labios:
         print("\n💄 Distribución de Color de Labios:")
         for temporada, count in sorted(temporadas_labios.items(), key=lambda x: x[1], reverse=True):
             print(f"   {temporada}: {count} ({count/exitosos*100:.1f}%)")
-    
+
     print("\n" + "="*60 + "\n")
 
 
 def main():
     """Función principal"""
+    parser = argparse.ArgumentParser(
+        description="ColorInsight - Procesamiento por lotes",
+        epilog="Ejemplo: python procesar_lote.py C:/Users/fotos/ --workers 4")
+    parser.add_argument('directorio', help='Directorio con imágenes')
+    parser.add_argument('--salida', default='resultados.jsonl',
+                        help='Archivo JSONL de resultados dentro del directorio')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Procesos en paralelo')
+    parser.add_argument('--recursivo', action='store_true',
+                        help='Incluir las imágenes de los subdirectorios')
+    parser.add_argument('--no-reanudar', action='store_true',
+                        help='Descartar resultados previos y procesar todo de nuevo')
+
     if len(sys.argv) < 2:
-        print("Uso: python procesar_lote.py <directorio_con_imagenes>")
-        print("Ejemplo: python procesar_lote.py C:/Users/fotos/")
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    try:
+        procesar_directorio(args.directorio, output_file=args.salida,
+                            workers=args.workers, reanudar=not args.no_reanudar,
+                            recursivo=args.recursivo)
+    except PoolRoto as e:
+        print(f"\n❌ {e}")
+        print("   Ejecute el mismo comando para reanudar desde lo ya guardado")
         sys.exit(1)
-    
-    ruta_directorio = sys.argv[1]
-    procesar_directorio(ruta_directorio)
 
 
 if __name__ == "__main__":
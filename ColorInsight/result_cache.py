@@ -0,0 +1,188 @@
+"""
+Caché de resultados de ColorInsight por contenido de imagen
+
+La clave es el SHA-256 de los bytes de la imagen junto con la versión de
+los modelos y ajustes que determinan el resultado (ver
+`model_registry.model_version`; las entradas de piel agregan además el hash
+del clasificador), de modo que una foto repetida (reintentos, re-escaneos
+del kiosco, lotes re-ejecutados) no vuelve a pasar por ningún modelo y un
+cambio de pesos invalida las entradas anteriores.
+
+Dos niveles:
+
+* LRU en memoria del proceso (COLORINSIGHT_CACHE_SIZE entradas)
+* SQLite en disco opcional (COLORINSIGHT_CACHE_DB), compartido entre
+  procesos, limitado a COLORINSIGHT_CACHE_DB_MB; al superarlo se desalojan
+  las entradas usadas hace más tiempo
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from model_registry import model_version
+
+
+# Escrituras entre recálculos del tamaño real de la caché en disco
+SYNC_EVERY = 256
+
+
+class ResultCache:
+    """
+    Args:
+        version: Identificador de los modelos; forma parte de cada clave.
+        max_items: Entradas del LRU en memoria (0 lo desactiva).
+        db_path: Archivo SQLite del segundo nivel (None lo desactiva).
+        max_db_bytes: Tamaño máximo de los resultados guardados en disco.
+    """
+
+    def __init__(self, version, max_items=256, db_path=None,
+                 max_db_bytes=256 * 1024 * 1024):
+        self.version = version
+        self.max_items = max_items
+        self.db_path = db_path
+        self.max_db_bytes = max_db_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._db = None
+        # Uso leído de disco pendiente de guardar (se escribe con el próximo put)
+        self._touched = {}
+        self._db_bytes = 0
+        self._puts = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            self._db.commit()
+            self._db_bytes = self._disk_bytes()
+
+    def key(self, content):
+        """Clave de caché para los bytes de una imagen"""
+        digest = hashlib.sha256(self.version.encode('utf-8'))
+        digest.update(content)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Resultado guardado para `key`, o None"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return value
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    # Sin escribir en la lectura: el uso se guarda con el próximo put
+                    self._touched[key] = time.time()
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self._stats['disk_hits'] += 1
+                    return value
+
+            self._stats['misses'] += 1
+            return None
+
+    def contains(self, key):
+        """Si hay un resultado para `key`, sin contar aciertos ni marcar su uso"""
+        with self._lock:
+            if key in self._memory:
+                return True
+            if self._db is not None:
+                return self._db.execute(
+                    'SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+            return False
+
+    def put(self, key, value):
+        """Guarda un resultado serializable a JSON en ambos niveles"""
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                data = json.dumps(value)
+                if self._touched:
+                    self._db.executemany(
+                        'UPDATE results SET last_used = ? WHERE key = ?',
+                        [(used, touched) for touched, used in self._touched.items()])
+                    self._touched.clear()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, value, size, last_used) '
+                    'VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+                self._db_bytes += len(data)
+                self._puts += 1
+                # El total es aproximado (reemplazos, otros procesos): se
+                # recalcula cada SYNC_EVERY escrituras y antes de desalojar
+                if self._puts % SYNC_EVERY == 0 or self._db_bytes > self.max_db_bytes:
+                    self._db_bytes = self._disk_bytes()
+                    self._evict_disk(key)
+                self._db.commit()
+
+    def _remember(self, key, value):
+        if self.max_items <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _disk_bytes(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def _evict_disk(self, keep):
+        """Borra las entradas usadas hace más tiempo, salvo `keep`, hasta
+        volver al límite"""
+        excess = self._db_bytes - self.max_db_bytes
+        if excess <= 0:
+            return
+        victims = []
+        freed = 0
+        rows = self._db.execute(
+            'SELECT key, size FROM results WHERE key != ? ORDER BY last_used', (keep,))
+        for key, size in rows:
+            if freed >= excess:
+                break
+            victims.append((key,))
+            freed += size
+        rows.close()
+        self._db.executemany('DELETE FROM results WHERE key = ?', victims)
+        self._db_bytes -= freed
+
+    def stats(self):
+        """Contadores de aciertos, sin consultar la base de datos"""
+        with self._lock:
+            stats = dict(self._stats, memory_entries=len(self._memory))
+            if self._db is not None:
+                stats['disk_bytes'] = self._db_bytes
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Caché compartida del proceso, o None si está desactivada"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                max_items = int(os.environ.get('COLORINSIGHT_CACHE_SIZE', '256'))
+                db_path = os.environ.get('COLORINSIGHT_CACHE_DB')
+                if max_items <= 0 and not db_path:
+                    return None
+                max_db_mb = int(os.environ.get('COLORINSIGHT_CACHE_DB_MB', '256'))
+                _cache = ResultCache(
+                    model_version(), max_items=max_items, db_path=db_path,
+                    max_db_bytes=max_db_mb * 1024 * 1024)
+    return _cache
@@ -4,39 +4,69 @@ import torchvision.transforms as transforms
 from PIL import Image
 import torch.nn as nn
 import os
+import numpy as np
 
-def get_season(img):
-    model = models.resnet18(pretrained=True)
-    num_classes = 4
+from model_registry import get_registry
+
+NUM_CLASSES = 4
+
+# Fine-tuned weights, next to this script
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'best_model_resnet_ALL.pth')
+
+
+def load_model(device='cpu'):
+    # The fine-tuned state dict overrides every layer, so the ImageNet
+    # weights are never needed here
+    model = models.resnet18(weights=None)
     in_features = model.fc.in_features
-    model.fc = nn.Linear(in_features, num_classes)
+    model.fc = nn.Linear(in_features, NUM_CLASSES)
 
     # load saved state dictionary
-    # Get the directory where this script is located
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    model_path = os.path.join(script_dir, 'best_model_resnet_ALL.pth')
-    state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+    state_dict = torch.load(MODEL_PATH, map_location=torch.device('cpu'))
+    model.load_state_dict(state_dict)
+
+    model.eval()
+    return model.to(device)
 
-    # create a new model with the correct architecture
-    new_model = models.resnet18(pretrained=True)
-    new_model.fc = nn.Linear(in_features, num_classes)
-    new_model.load_state_dict(state_dict)
 
-    transform = transforms.Compose([
-        transforms.RandomHorizontalFlip(p=0.5),
-        transforms.RandomVerticalFlip(p=0.5),
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize((0.5,), (0.5,))
-    ])
+# Fixed test-time augmentation: identity, horizontal, vertical and both
+# flips. These are the four outcomes of the random flips used in training,
+# so averaging them replaces sampling one at random.
+TTA_FLIP_DIMS = ([], [-1], [-2], [-2, -1])
 
-    image = Image.open(img).convert('RGB')
-    image = transform(image).unsqueeze(0)
+transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize((0.5,), (0.5,))
+])
 
-    new_model.eval()
+
+def predict_season(img, tta=True):
+    # img: PIL image, h x w x 3 RGB uint8 array or path to an image file
+    # Returns the class probabilities as a numpy array of NUM_CLASSES
+    registry = get_registry()
+    new_model = registry.classifier()
+
+    if isinstance(img, np.ndarray):
+        image = Image.fromarray(img)
+    elif isinstance(img, Image.Image):
+        image = img.convert('RGB')
+    else:
+        image = Image.open(img).convert('RGB')
+    image = transform(image)
+
+    flip_dims = TTA_FLIP_DIMS if tta else TTA_FLIP_DIMS[:1]
+    batch = torch.stack([image.flip(dims) if dims else image for dims in flip_dims])
+    batch = batch.to(registry.device)
 
     with torch.no_grad():
-        output = new_model(image)
-    pred_index = output.argmax().item()
+        output = new_model(batch).mean(dim=0)  # average logits over the flips
+    return output.softmax(dim=0).cpu().numpy()
+
+
+def get_season(img, tta=True):
+    probs = predict_season(img, tta=tta)
+    pred_index = int(probs.argmax())
     print("Decided color: ",pred_index)
     return pred_index
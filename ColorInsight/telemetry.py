@@ -0,0 +1,133 @@
+"""
+Tiempos por etapa del pipeline de ColorInsight
+
+Cada etapa (decodificación, detección, parsing, extracción de máscaras,
+clasificación de piel y paleta de labios) se mide con `span` y se acumula
+en un histograma por proceso. La API lo expone en formato Prometheus
+(`GET /metrics`) y la CLI imprime un resumen con `--profile`.
+
+Con micro-batching, las etapas de detección, parsing y máscaras se miden
+una vez por lote, no por imagen.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+STAGES = ('decode', 'detect', 'parse', 'mask', 'classify', 'palette')
+
+# Límites superiores (segundos) de los buckets del histograma
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Duraciones recientes por etapa para los percentiles del resumen
+RECENT = 10000
+
+
+class StageTimer:
+
+    def __init__(self, stages=STAGES, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._sums = {}
+        self._bucket_counts = {}
+        self._recent = {}
+        for stage in stages:
+            self._add_stage(stage)
+
+    def _add_stage(self, stage):
+        self._counts[stage] = 0
+        self._sums[stage] = 0.0
+        self._bucket_counts[stage] = [0] * len(self.buckets)
+        self._recent[stage] = deque(maxlen=RECENT)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self._counts:
+                self._add_stage(stage)
+            self._counts[stage] += 1
+            self._sums[stage] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self._bucket_counts[stage][i] += 1
+            self._recent[stage].append(seconds)
+
+    @contextmanager
+    def span(self, stage, device=None):
+        """
+        Mide el bloque como una ejecución de `stage`
+
+        Con un `device` CUDA se sincroniza al final, para que el tiempo de
+        los kernels encolados se atribuya a esta etapa y no a la siguiente.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if device is not None and str(device).startswith('cuda'):
+                import torch
+                torch.cuda.synchronize(device)
+            self.observe(stage, time.perf_counter() - start)
+
+    def summary(self):
+        """Por etapa: ejecuciones, media, p50, p95 y máximo en milisegundos"""
+        with self._lock:
+            recent = {stage: sorted(values) for stage, values in self._recent.items()}
+            counts = dict(self._counts)
+            sums = dict(self._sums)
+
+        result = {}
+        for stage, values in recent.items():
+            if not values:
+                continue
+
+            def percentile(q):
+                return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+            result[stage] = {
+                'count': counts[stage],
+                'mean_ms': round(sums[stage] / counts[stage] * 1000, 2),
+                'p50_ms': round(percentile(0.50), 2),
+                'p95_ms': round(percentile(0.95), 2),
+                'max_ms': round(values[-1] * 1000, 2),
+            }
+        return result
+
+    def prometheus(self, name='colorinsight_stage_seconds'):
+        """Histograma por etapa en el formato de texto de Prometheus"""
+        lines = [
+            f'# HELP {name} Duración de cada etapa del pipeline',
+            f'# TYPE {name} histogram',
+        ]
+        with self._lock:
+            for stage in self._counts:
+                for bound, count in zip(self.buckets, self._bucket_counts[stage]):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {self._counts[stage]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {self._sums[stage]:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {self._counts[stage]}')
+        return '\n'.join(lines) + '\n'
+
+
+# Acumulador compartido del proceso
+timer = StageTimer()
+span = timer.span
+
+
+def imprimir_perfil():
+    """Resumen de tiempos por etapa para la CLI"""
+    summary = timer.summary()
+    print("\n" + "="*60)
+    print("⏱️  PERFIL POR ETAPA")
+    print("="*60)
+    if not summary:
+        print("Sin mediciones (resultado desde la caché)")
+        print("="*60 + "\n")
+        return
+    print(f"{'Etapa':<10}{'n':>6}{'media ms':>11}{'p50 ms':>10}{'p95 ms':>10}{'máx ms':>10}")
+    for stage, values in summary.items():
+        print(f"{stage:<10}{values['count']:>6}{values['mean_ms']:>11.1f}"
+              f"{values['p50_ms']:>10.1f}{values['p95_ms']:>10.1f}{values['max_ms']:>10.1f}")
+    print("="*60 + "\n")
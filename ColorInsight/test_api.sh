@@ -22,3 +22,21 @@ curl -X POST "http://localhost:8000/lip" \
   -d "{\"image\": \"data:image/jpeg;base64,$IMAGE_BASE64\"}"
 
 echo -e "\n"
+
+echo -e "\n"
+
+# Variantes sin base64: multipart/form-data y bytes directos
+echo "Testing /image endpoint (multipart)..."
+
+curl -X POST "http://localhost:8000/image" \
+  -F "image=@tu_foto.jpg"
+
+echo -e "\n\n"
+
+echo "Testing /lip endpoint (octet-stream)..."
+
+curl -X POST "http://localhost:8000/lip" \
+  -H "Content-Type: application/octet-stream" \
+  --data-binary "@tu_foto.jpg"
+
+echo -e "\n"